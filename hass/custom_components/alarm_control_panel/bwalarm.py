@@ -4,7 +4,6 @@
 import asyncio
 import datetime
 import logging
-import enum
 import re
 import voluptuous as vol
 from operator import attrgetter
@@ -13,12 +12,19 @@ from homeassistant.const import (
     STATE_ALARM_ARMED_AWAY, STATE_ALARM_ARMED_HOME, STATE_ALARM_DISARMED,
     STATE_ALARM_PENDING, STATE_ALARM_TRIGGERED, CONF_PLATFORM, CONF_NAME,
     CONF_CODE, CONF_PENDING_TIME, CONF_TRIGGER_TIME, CONF_DISARM_AFTER_TRIGGER,
-    EVENT_STATE_CHANGED, EVENT_TIME_CHANGED, STATE_ON)
+    EVENT_HOMEASSISTANT_START, EVENT_HOMEASSISTANT_STOP, STATE_ON, HTTP_NOT_FOUND)
+from homeassistant.core import callback
+from homeassistant.components.http import HomeAssistantView
 from homeassistant.util.dt import utcnow as now
-from homeassistant.helpers.event import async_track_point_in_time
+from homeassistant.helpers.event import async_track_state_change
 import homeassistant.components.alarm_control_panel as alarm
 import homeassistant.components.switch as switch
 import homeassistant.helpers.config_validation as cv
+import custom_components.bwalarmfsm as fsm
+from custom_components.bwalarmfsm import Events, Actions, AlarmMachine, STATE_ALARM_WARNING
+from custom_components.bwalarmjournal import AlarmJournal
+from custom_components.deltafeed import DeltaFeed
+from custom_components.looptimer import track_point_in_utc_time
 
 CONF_HEADSUP   = 'headsup'
 CONF_IMMEDIATE = 'immediate'
@@ -27,18 +33,14 @@ CONF_NOTATHOME = 'notathome'
 CONF_ALARM     = 'alarm'
 CONF_WARNING   = 'warning'
 
-# Add a new state for the time after an delayed sensor and an actual alarm
-STATE_ALARM_WARNING = 'warning'
-
-class Events(enum.Enum):
-    ImmediateTrip = 1
-    DelayedTrip   = 2
-    ArmHome       = 3
-    ArmAway       = 4
-    Timeout       = 5
-    Disarm        = 6
-    Trigger       = 7
-    
+EVENT_DELTA    = 'bwalarm_delta'
+
+# The state machine carries its own copy of the state strings so it doesn't need HASS
+assert (fsm.STATE_ALARM_DISARMED, fsm.STATE_ALARM_ARMED_HOME, fsm.STATE_ALARM_ARMED_AWAY,
+        fsm.STATE_ALARM_PENDING, fsm.STATE_ALARM_TRIGGERED) == \
+       (STATE_ALARM_DISARMED, STATE_ALARM_ARMED_HOME, STATE_ALARM_ARMED_AWAY,
+        STATE_ALARM_PENDING, STATE_ALARM_TRIGGERED), "bwalarmfsm states out of sync with HASS"
+
 PLATFORM_SCHEMA = vol.Schema({
     vol.Required(CONF_PLATFORM):  'bwalarm',
     vol.Required(CONF_NAME):      cv.string,
@@ -53,12 +55,20 @@ PLATFORM_SCHEMA = vol.Schema({
 })
 
 _LOGGER = logging.getLogger(__name__)
+DEPENDENCIES = ['http']
+ALARMS = []
 
 @asyncio.coroutine
 def async_setup_platform(hass, config, async_add_devices, discovery_info=None):
     alarm = BWAlarm(hass, config)
-    hass.bus.async_listen(EVENT_STATE_CHANGED, alarm.state_change_listener)
-    hass.bus.async_listen(EVENT_TIME_CHANGED, alarm.time_change_listener)
+    if not ALARMS:
+        hass.http.register_view(BWAlarmView(ALARMS))
+    ALARMS.append(alarm)
+    # only the inputs can trip us, don't get woken for every other state change in the house
+    async_track_state_change(hass, alarm._allinputs, alarm.state_change_listener)
+    # pick up where we left off once everything else is loaded
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_START, alarm.restore)
+    hass.bus.async_listen_once(EVENT_HOMEASSISTANT_STOP, lambda e: alarm._journal.close())
     async_add_devices([alarm])
 
 
@@ -79,9 +89,24 @@ class BWAlarm(alarm.AlarmControlPanel):
         self._trigger_time = datetime.timedelta(seconds=config[CONF_TRIGGER_TIME])
 
         self._lasttrigger  = ""
-        self._state        = STATE_ALARM_DISARMED
-        self._returnto     = STATE_ALARM_DISARMED
+        self._attributes   = {'changedby': ""}
+        self._groups       = dict()  # sensor -> immediate, delayed, ignored or headsup
+        self._feed         = DeltaFeed(hass, EVENT_DELTA)
+        self._fsm          = AlarmMachine()
         self._timeoutat    = None
+        self._canceltimer  = None
+        self._journal      = AlarmJournal(hass.config.path('bwalarm.journal'))
+        self._actions      = {
+            Actions.WarningOn:    lambda: switch.turn_on(self._hass, self._warning),
+            Actions.WarningOff:   lambda: switch.turn_off(self._hass, self._warning),
+            Actions.AlarmOn:      lambda: switch.turn_on(self._hass, self._alarm),
+            Actions.AlarmOff:     lambda: switch.turn_off(self._hass, self._alarm),
+            Actions.PendingTimer: lambda: self.settimeout(self._pending_time),
+            Actions.TriggerTimer: lambda: self.settimeout(self._trigger_time),
+            Actions.SignalsAway:  lambda: self.setsignals(False),
+            Actions.SignalsHome:  lambda: self.setsignals(True),
+            Actions.SignalsClear: self.clearsignals,
+        }
         self.clearsignals()
 
     ### Alarm properties
@@ -93,33 +118,35 @@ class BWAlarm(alarm.AlarmControlPanel):
     @property
     def changed_by(self) -> str:   return self._lasttrigger
     @property
-    def state(self) -> str:        return self._state
+    def state(self) -> str:        return self._fsm.state
     @property
     def device_state_attributes(self):
-        return {
-            'immediate':  sorted(list(self.immediate)),
-            'delayed':    sorted(list(self.delayed)),
-            'ignored':    sorted(list(self.ignored)),
-            'allsensors': sorted(list(self._allsensors)),
-            'changedby':  self.changed_by
-        }
+        """ Kept small as it is recorded with every change, the panel gets the sensor groups from BWAlarmView and the feed """
+        if self._attributes['changedby'] != self._lasttrigger:
+            self._attributes = {'changedby': self._lasttrigger}
+        return self._attributes
+
+    def snapshot(self):
+        return self._feed.snapshot(lambda: {'sensors': dict(self._groups)})
 
 
     ### Actions from the outside world that affect us, turn into enum events for internal processing
 
-    def time_change_listener(self, eventignored):
-        """ I just treat the time events as a periodic check, its simpler then (re-/un-)registration """
-        if self._timeoutat is not None:
-            if now() > self._timeoutat:
-                self._timeoutat = None
-                self.process_event(Events.Timeout)
+    def timeout_listener(self, when):
+        """ One shot timer for the timed states, ignore a stale one that fired as it was being cancelled """
+        if self._timeoutat is None or when < self._timeoutat:
+            return
+        self._canceltimer = None
+        self._timeoutat = None
+        self.process_event(Events.Timeout)
 
-    def state_change_listener(self, event):
-        """ Something changed, we only care about things turning on at this point """
-        new = event.data.get('new_state', None)
+    def state_change_listener(self, eid, old, new):
+        """ One of our inputs changed, we only care about things turning on at this point """
         if new is None or new.state != STATE_ON:
             return
-        eid = event.data['entity_id']
+        if old is None:
+            return # first state for the entity at startup, not something opening
+
         if eid in self.immediate:
             self._lasttrigger = eid
             self.process_event(Events.ImmediateTrip)
@@ -142,95 +169,153 @@ class BWAlarm(alarm.AlarmControlPanel):
 
     ### Internal processing
 
-    def noton(self, eid):
-        """ For filtering out sensors already tripped """
-        return not self._hass.states.is_state(eid, STATE_ON)
-
-    def setsignals(self, athome):
-        """ Figure out what to sense and how """
-        self.immediate = set(filter(self.noton, self._immediate))
-        self.delayed = set(filter(self.noton, self._delayed))
+    def tripped(self):
+        """ Inputs already on, read in the loop so no state can change while we look """
+        return asyncio.run_coroutine_threadsafe(self.async_tripped(), self._hass.loop).result()
+
+    @asyncio.coroutine
+    def async_tripped(self):
+        return self.readtripped()
+
+    def readtripped(self):
+        tripped = set()
+        for eid in self._allinputs:
+            state = self._hass.states.get(eid)
+            if state is not None and state.state == STATE_ON:
+                tripped.add(eid)
+        return tripped
+
+    def setsignals(self, athome, tripped=None):
+        """ Figure out what to sense and how, filtering out sensors already tripped from one snapshot """
+        if tripped is None:
+            tripped = self.tripped()
+        self.immediate = self._immediate - tripped
+        self.delayed = self._delayed - tripped
         if athome:
             self.immediate -= self._notathome
             self.delayed -= self._notathome
         self.ignored = self._allinputs - (self.immediate | self.delayed)
+        self.snapshotsignals()
+
+    def settimeout(self, delta):
+        """ Schedule a Timeout event delta from now """
+        self.canceltimeout()
+        self._timeoutat = now() + delta
+        self._canceltimer = track_point_in_utc_time(self._hass, self.timeout_listener, self._timeoutat)
+
+    def canceltimeout(self):
+        """ Drop any outstanding timer, nothing runs while we sit in an untimed state """
+        if self._canceltimer is not None:
+            self._canceltimer()
+            self._canceltimer = None
+        self._timeoutat = None
+
+    def restoresignals(self, immediate, delayed):
+        """ Sense what we were sensing before the restart, anything since dropped from the config stays out """
+        self.immediate = self._immediate & set(immediate)
+        self.delayed = self._delayed & set(delayed)
+        self.ignored = self._allinputs - (self.immediate | self.delayed)
+        self.snapshotsignals()
 
     def clearsignals(self):
         """ Clear all our signals, we aren't listening anymore """
         self.immediate = set()
         self.delayed = set()
         self.ignored = self._allinputs.copy()
+        self.snapshotsignals()
+
+    def snapshotsignals(self):
+        """ The signal sets only change here, send the panel just the sensors that moved group """
+        for eid in self._allsensors:
+            if eid in self.immediate:  group = 'immediate'
+            elif eid in self.delayed:  group = 'delayed'
+            elif eid in self.ignored:  group = 'ignored'
+            else:                      group = 'headsup'
+            if self._groups.get(eid) != group:
+                self._groups[eid] = group
+                self._feed.change(eid, group)
+        if self.entity_id is not None:  # not until HASS has added us, the panel snapshot covers the rest
+            self._feed.flush(entity_id=self.entity_id)
 
     def process_event(self, event):
-        """ 
-           This is the core logic function.
-           The possible states and things that can change our state are:
-                 Actions:  isensor dsensor timeout arm_home arm_away disarm trigger
-           Current State: 
-             disarmed         X       X       X      armh     pend     *     trig
-             pending(T1)      X       X      arma     X        X      dis    trig
-             armed(h/a)      trig    warn     X       X        X      dis    trig
-             warning(T1)      X       X      trig     X        X      dis    trig
-             triggered(T2)    X       X      last     X        X      dis     *
-
-           As the only non-timed states are disarmed, armed_home and armed_away,
-           they are the only ones we can return to after an alarm.
-        """
-        old = self._state
-
-        # Update state if applicable
-        if event == Events.Disarm:
-            self._state = STATE_ALARM_DISARMED
-        elif event == Events.Trigger:
-            self._state = STATE_ALARM_TRIGGERED 
-        elif old == STATE_ALARM_DISARMED:
-            if   event == Events.ArmHome:       self._state = STATE_ALARM_ARMED_HOME
-            elif event == Events.ArmAway:       self._state = STATE_ALARM_PENDING
-        elif old == STATE_ALARM_PENDING:
-            if   event == Events.Timeout:       self._state = STATE_ALARM_ARMED_AWAY
-        elif old == STATE_ALARM_ARMED_HOME or \
-             old == STATE_ALARM_ARMED_AWAY:
-            if   event == Events.ImmediateTrip: self._state = STATE_ALARM_TRIGGERED
-            elif event == Events.DelayedTrip:   self._state = STATE_ALARM_WARNING
-        elif old == STATE_ALARM_WARNING:
-            if   event == Events.Timeout:       self._state = STATE_ALARM_TRIGGERED
-        elif old == STATE_ALARM_TRIGGERED:
-            if   event == Events.Timeout:       self._state = self._returnto
-
-        new = self._state
-        if old != new: 
-            _LOGGER.debug("Alarm changing from {} to {}".format(old, new))
-            # Things to do on entering state
-            if new == STATE_ALARM_WARNING:
-                _LOGGER.debug("Turning on warning")
-                switch.turn_on(self._hass, self._warning)
-                self._timeoutat = now() + self._pending_time
-            elif new == STATE_ALARM_TRIGGERED:
-                _LOGGER.debug("Turning on alarm")
-                switch.turn_on(self._hass, self._alarm)
-                self._timeoutat = now() + self._trigger_time
-            elif new == STATE_ALARM_PENDING:
-                _LOGGER.debug("Pending user leaving house")
-                switch.turn_on(self._hass, self._warning)
-                self._timeoutat = now() + self._pending_time
-                self._returnto = STATE_ALARM_ARMED_AWAY
-                self.setsignals(False)
-            elif new == STATE_ALARM_ARMED_HOME:
-                self._returnto = new
-                self.setsignals(True)
-            elif new == STATE_ALARM_DISARMED:
-                self._returnto = new
-                self.clearsignals()
-
-            # Things to do on leaving state
-            if old == STATE_ALARM_WARNING or old == STATE_ALARM_PENDING:
-                _LOGGER.debug("Turning off warning")
-                switch.turn_off(self._hass, self._warning)
-            elif old == STATE_ALARM_TRIGGERED:
-                _LOGGER.debug("Turning off alarm")
-                switch.turn_off(self._hass, self._alarm)
-
-            # Let HA know that something changed
-            self.schedule_update_ha_state()
+        """ The core logic, the transition table and entry/exit actions live in bwalarmfsm """
+        old = self._fsm.state
+        t = self._fsm.process(event)
+        if not t.changed:
+            return
+
+        _LOGGER.debug("Alarm changing from {} to {}".format(old, t.state))
+        self.canceltimeout()
+        for action in t.entry:
+            self._actions[action]()
+        for action in t.exit:
+            self._actions[action]()
+
+        self._journal.append({
+            't':         now().timestamp(),
+            'event':     event.name,
+            'by':        self._lasttrigger,
+            'old':       old,
+            'new':       t.state,
+            'returnto':  t.returnto,
+            'timeout':   self._timeoutat and self._timeoutat.timestamp(),
+            'immediate': sorted(self.immediate),
+            'delayed':   sorted(self.delayed)
+        })
+
+        # Let HA know that something changed
+        self.schedule_update_ha_state()
+
+    def restore(self, eventignored):
+        """ Replay the journal at startup: state, signals, switches and any timeout still running """
+        record = self._journal.replay()
+        self._journal.start()
+        if record is None:
+            return
+
+        state, returnto = record['new'], record['returnto']
+        _LOGGER.info("Restoring alarm state {} (returns to {})".format(state, returnto))
+        self._fsm.restore(state, returnto)
+        self._lasttrigger = record['by'] or ""
+
+        # No input has reported yet so their states can't tell us what is tripped, use what we were sensing.
+        # Older records don't have that, go by what we go back to and count nothing as tripped.
+        if 'immediate' in record:
+            self.restoresignals(record['immediate'], record['delayed'])
+        elif returnto == STATE_ALARM_ARMED_HOME:
+            self.setsignals(True, tripped=set())
+        elif returnto == STATE_ALARM_ARMED_AWAY:
+            self.setsignals(False, tripped=set())
+        else:
+            self.clearsignals()
+
+        self.schedule_update_ha_state()
+        if record['timeout'] is not None:
+            timeoutat = datetime.datetime.fromtimestamp(record['timeout'], datetime.timezone.utc)
+            if timeoutat <= now():
+                # ran out while we were down, go straight on without switching on what that state had on
+                self.process_event(Events.Timeout)
+                return
+            self.settimeout(timeoutat - now())
+
+        if state in (STATE_ALARM_PENDING, STATE_ALARM_WARNING):
+            self._actions[Actions.WarningOn]()
+        elif state == STATE_ALARM_TRIGGERED:
+            self._actions[Actions.AlarmOn]()
+
+
+class BWAlarmView(HomeAssistantView):
+    """ Snapshot of the sensor groups for the alarm panel, EVENT_DELTA has the changes after seq """
+
+    url = '/api/bwalarm/{entity_id}'
+    name = 'api:bwalarm'
 
+    def __init__(self, alarms):
+        self.alarms = alarms
 
+    @callback
+    def get(self, request, entity_id):
+        for alarm in self.alarms:
+            if alarm.entity_id == entity_id:
+                return self.json(alarm.snapshot())
+        return self.json_message('No alarm {}'.format(entity_id), HTTP_NOT_FOUND)
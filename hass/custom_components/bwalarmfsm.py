@@ -0,0 +1,142 @@
+"""
+  The state machine behind bwalarm, kept free of HASS imports so it can be fuzzed and benchmarked on its own.
+
+  The possible states and things that can change our state are:
+        Actions:  isensor dsensor timeout arm_home arm_away disarm trigger
+  Current State:
+    disarmed         X       X       X      armh     pend     *     trig
+    pending(T1)      X       X      arma     X        X      dis    trig
+    armed(h/a)      trig    warn     X       X        X      dis    trig
+    warning(T1)      X       X      trig     X        X      dis    trig
+    triggered(T2)    X       X      last     X        X      dis     *
+
+  As the only non-timed states are disarmed, armed_home and armed_away,
+  they are the only ones we can return to after an alarm.  So the machine is really
+  (state, returnto) and the whole thing is precomputed into a lookup table at import.
+"""
+import enum
+from collections import namedtuple
+
+# Same strings as the HASS constants
+STATE_ALARM_DISARMED   = 'disarmed'
+STATE_ALARM_ARMED_HOME = 'armed_home'
+STATE_ALARM_ARMED_AWAY = 'armed_away'
+STATE_ALARM_PENDING    = 'pending'
+STATE_ALARM_TRIGGERED  = 'triggered'
+# Add a new state for the time after an delayed sensor and an actual alarm
+STATE_ALARM_WARNING    = 'warning'
+
+STATES    = (STATE_ALARM_DISARMED, STATE_ALARM_ARMED_HOME, STATE_ALARM_ARMED_AWAY,
+             STATE_ALARM_PENDING, STATE_ALARM_WARNING, STATE_ALARM_TRIGGERED)
+RETURNTOS = (STATE_ALARM_DISARMED, STATE_ALARM_ARMED_HOME, STATE_ALARM_ARMED_AWAY)
+
+class Events(enum.Enum):
+    ImmediateTrip = 1
+    DelayedTrip   = 2
+    ArmHome       = 3
+    ArmAway       = 4
+    Timeout       = 5
+    Disarm        = 6
+    Trigger       = 7
+
+class Actions(enum.Enum):
+    WarningOn      = 1
+    WarningOff     = 2
+    AlarmOn        = 3
+    AlarmOff       = 4
+    PendingTimer   = 5   # start a timer for pending_time
+    TriggerTimer   = 6   # start a timer for trigger_time
+    SignalsAway    = 7   # figure out what to sense, all inputs
+    SignalsHome    = 8   # figure out what to sense, skipping notathome
+    SignalsClear   = 9   # stop sensing
+
+# Sentinel for going back to whatever we were before the alarm
+RETURN = 'return'
+
+_MATRIX = {
+    #                       ImmediateTrip          DelayedTrip          Timeout                ArmHome                 ArmAway              Disarm                Trigger
+    STATE_ALARM_DISARMED:   (None,                  None,                None,                  STATE_ALARM_ARMED_HOME, STATE_ALARM_PENDING, STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+    STATE_ALARM_PENDING:    (None,                  None,                STATE_ALARM_ARMED_AWAY, None,                  None,                STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+    STATE_ALARM_ARMED_HOME: (STATE_ALARM_TRIGGERED, STATE_ALARM_WARNING, None,                  None,                   None,                STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+    STATE_ALARM_ARMED_AWAY: (STATE_ALARM_TRIGGERED, STATE_ALARM_WARNING, None,                  None,                   None,                STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+    STATE_ALARM_WARNING:    (None,                  None,                STATE_ALARM_TRIGGERED, None,                   None,                STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+    STATE_ALARM_TRIGGERED:  (None,                  None,                RETURN,                None,                   None,                STATE_ALARM_DISARMED, STATE_ALARM_TRIGGERED),
+}
+_COLUMNS = (Events.ImmediateTrip, Events.DelayedTrip, Events.Timeout, Events.ArmHome, Events.ArmAway, Events.Disarm, Events.Trigger)
+
+# Things to do on entering a state and what returnto becomes (None for unchanged)
+_ENTRY = {
+    STATE_ALARM_WARNING:    ((Actions.WarningOn, Actions.PendingTimer),                        None),
+    STATE_ALARM_TRIGGERED:  ((Actions.AlarmOn, Actions.TriggerTimer),                          None),
+    STATE_ALARM_PENDING:    ((Actions.WarningOn, Actions.PendingTimer, Actions.SignalsAway),   STATE_ALARM_ARMED_AWAY),
+    STATE_ALARM_ARMED_HOME: ((Actions.SignalsHome,),                                           STATE_ALARM_ARMED_HOME),
+    STATE_ALARM_ARMED_AWAY: ((),                                                               None),
+    STATE_ALARM_DISARMED:   ((Actions.SignalsClear,),                                          STATE_ALARM_DISARMED),
+}
+
+# Things to do on leaving a state
+_EXIT = {
+    STATE_ALARM_WARNING:    (Actions.WarningOff,),
+    STATE_ALARM_PENDING:    (Actions.WarningOff,),
+    STATE_ALARM_TRIGGERED:  (Actions.AlarmOff,),
+    STATE_ALARM_ARMED_HOME: (),
+    STATE_ALARM_ARMED_AWAY: (),
+    STATE_ALARM_DISARMED:   (),
+}
+
+# changed is False when nothing happens, mode is the (state, returnto) key of the next row
+Transition = namedtuple('Transition', 'changed state returnto entry exit mode')
+
+
+def _build():
+    """ Expand the matrix into {(state, returnto): {event: Transition}} """
+    table = dict()
+    for state, row in _MATRIX.items():
+        for returnto in RETURNTOS:
+            events = table[(state, returnto)] = dict()
+            for event, nxt in zip(_COLUMNS, row):
+                if nxt == RETURN:
+                    nxt = returnto
+                if nxt is None or nxt == state:
+                    events[event] = Transition(False, state, returnto, (), (), (state, returnto))
+                    continue
+                entry, newreturn = _ENTRY[nxt]
+                newreturn = newreturn or returnto
+                events[event] = Transition(True, nxt, newreturn, entry, _EXIT[state], (nxt, newreturn))
+    return table
+
+def _validate(table):
+    """ Every (state, returnto) has an answer for every event and leads somewhere we know """
+    assert set(_MATRIX) == set(STATES), "matrix rows don't match states"
+    assert set(_COLUMNS) == set(Events), "matrix columns don't match events"
+    for mode in ((s, r) for s in STATES for r in RETURNTOS):
+        assert mode in table, "missing mode {}".format(mode)
+        assert set(table[mode]) == set(Events), "missing events for {}".format(mode)
+        for event, t in table[mode].items():
+            assert t.mode in table, "{} {} leads to unknown mode {}".format(mode, event, t.mode)
+            assert t.returnto in RETURNTOS, "{} {} returns to timed state {}".format(mode, event, t.returnto)
+
+TABLE = _build()
+_validate(TABLE)
+
+
+class AlarmMachine(object):
+    """ Current row of the table, process() is a couple of dict lookups """
+
+    def __init__(self, state=STATE_ALARM_DISARMED, returnto=STATE_ALARM_DISARMED):
+        self.restore(state, returnto)
+
+    def restore(self, state, returnto):
+        """ Jump straight to a state, no actions """
+        self._row = TABLE[(state, returnto)]
+        self.state = state
+        self.returnto = returnto
+
+    def process(self, event):
+        """ Returns the Transition, check .changed before acting on it """
+        t = self._row[event]
+        if t.changed:
+            self._row = TABLE[t.mode]
+            self.state = t.state
+            self.returnto = t.returnto
+        return t
@@ -0,0 +1,102 @@
+"""
+  Append-only journal of bwalarm transitions so the alarm can pick up where it left off after a restart.
+  One JSON object per line:
+
+    {"t": epoch, "event": "DelayedTrip", "by": "binary_sensor.front_door", "old": "armed_away",
+     "new": "warning", "returnto": "armed_away", "timeout": epoch or null,
+     "immediate": [sensors], "delayed": [sensors]}
+
+  Each record carries the complete state, so replay only needs the last good line.  A torn last line
+  from a crash is skipped and compacted away before anything is appended after it.  Compaction keeps the
+  most recent KEEP records so startup stays cheap.
+"""
+import collections
+import json
+import logging
+import os
+import queue
+import threading
+
+_LOGGER = logging.getLogger(__name__)
+
+
+class AlarmJournal(object):
+    """ Records are handed to a writer thread, nobody waits on the disk """
+
+    KEEP  = 200    # records left after compaction
+    LIMIT = 1000   # compact when the file has more than this
+
+    def __init__(self, path):
+        self._path = path
+        self._count = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name='bwalarm-journal', daemon=True)
+
+    def replay(self):
+        """ Read the journal, compact it if needed and return the last record (or None) """
+        try:
+            with open(self._path, 'r') as fp:
+                lines = 0
+                records = collections.deque(maxlen=self.KEEP)
+                for line in fp:
+                    lines += 1
+                    records.extend(self._parse([line]))
+        except FileNotFoundError:
+            return None
+        # a bad line has to go now, the next append would land on the end of a torn one
+        if lines > len(records):
+            self._compact(records)
+        self._count = len(records)
+        return records[-1] if records else None
+
+    def start(self):
+        self._thread.start()
+
+    def append(self, record):
+        self._queue.put(record)
+
+    def close(self):
+        self._queue.put(None)
+        if self._thread.is_alive():
+            self._thread.join()
+
+    @staticmethod
+    def _parse(lines):
+        for line in lines:
+            try:
+                yield json.loads(line)
+            except ValueError:
+                _LOGGER.warning("Skipping bad journal line: {}".format(line.strip()))
+
+    def _compact(self, records):
+        """ Rewrite with just the given records, swapped in atomically """
+        tmp = self._path + '.tmp'
+        with open(tmp, 'w') as fp:
+            for record in records:
+                fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp, self._path)
+
+    def _writer(self):
+        fp = open(self._path, 'a')
+        while True:
+            record = self._queue.get()
+            if record is None:
+                break
+            try:
+                fp.write(json.dumps(record, separators=(',', ':')) + '\n')
+                fp.flush()
+                self._count += 1
+                if self._count > self.LIMIT:
+                    fp.close()
+                    try:
+                        with open(self._path, 'r') as rp:
+                            tail = list(self._parse(collections.deque(rp, maxlen=self.KEEP)))
+                        self._compact(tail)
+                        self._count = len(tail)
+                    finally:
+                        fp = open(self._path, 'a')
+            except Exception as e:
+                _LOGGER.error("Unable to write alarm journal: {}".format(e))
+        fp.close()
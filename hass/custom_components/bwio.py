@@ -2,7 +2,8 @@
  Support for my little custom I/O board from years ago
 """
 import logging
-import re
+import threading
+import time
 import serial
 import serial.threaded
 
@@ -13,6 +14,7 @@ from homeassistant.const import (CONF_PLATFORM, CONF_PORT, CONF_NAME, STATE_ON,
 from homeassistant.components.switch import SwitchDevice
 from homeassistant.components.binary_sensor import BinarySensorDevice
 import homeassistant.helpers.config_validation as cv
+from custom_components.bwioproto import BWIODecoder, InputReport, OutputReport, SampleReport
 
 REQUIREMENTS = ['pyserial>=3.1.1']
 _LOGGER = logging.getLogger(__name__)
@@ -20,10 +22,20 @@ BOARD = None
 DOMAIN = 'bwio'
 CONF_PINS = 'pins'
 CONF_HIDE = 'hide'
+CONF_WRITE_WINDOW = 'write_window'
+CONF_TRANSPORT = 'transport'
+CONF_DEBOUNCE = 'debounce'
+CONF_MIN_ON = 'min_on'
+CONF_MIN_OFF = 'min_off'
+CONF_HOLDOFF = 'holdoff'
+
+MILLISECONDS = vol.All(vol.Coerce(int), vol.Range(min=0))
 
 CONFIG_SCHEMA = vol.Schema({
     DOMAIN: vol.Schema({
         vol.Required(CONF_PORT): cv.string,
+        vol.Optional(CONF_WRITE_WINDOW, default=20): MILLISECONDS,
+        vol.Optional(CONF_TRANSPORT, default='thread'): vol.In(['thread', 'asyncio']),
     }),
 }, extra=vol.ALLOW_EXTRA)
 
@@ -37,15 +49,26 @@ BWIO_INPUT_SCHEMA = vol.Schema ({
     vol.Required(CONF_PLATFORM): DOMAIN,
     vol.Optional(CONF_HIDE, default=False): cv.boolean,
     vol.Required(CONF_PINS): vol.Schema({
-         cv.positive_int: [ cv.string ] }) # can voluptous do array with different types?
+         cv.positive_int: [ cv.string ] }), # can voluptous do array with different types?
+    vol.Optional(CONF_DEBOUNCE, default={}): vol.Schema({
+         cv.positive_int: vol.Schema({
+            vol.Optional(CONF_MIN_ON,  default=0): MILLISECONDS,  # must stay on this long before we believe it
+            vol.Optional(CONF_MIN_OFF, default=0): MILLISECONDS,  # must stay off this long before we believe it
+            vol.Optional(CONF_HOLDOFF, default=0): MILLISECONDS   # minimum time between publishing changes
+         }) })
 })
 
 
 def setup(hass, config):
     """ Setup the BWIO interface, there are 16 inputs and 16 relay outputs """
     global BOARD
+    conf = config[DOMAIN]
     try:
-        BOARD = BWIOBoard(config[DOMAIN][CONF_PORT])
+        if conf[CONF_TRANSPORT] == 'asyncio':
+            transport = BWIOAsyncTransport(conf[CONF_PORT], hass.loop)
+        else:
+            transport = BWIOThreadedTransport(conf[CONF_PORT])
+        BOARD = BWIOBoard(transport, conf[CONF_WRITE_WINDOW]/1000.0)
     except (serial.serialutil.SerialException, FileNotFoundError):
         _LOGGER.exception("BWIO port (%s) is not accessible." % (config[DOMAIN][CONF_PORT]))
         return False
@@ -63,33 +86,46 @@ def setup_pins(buildfunc, hass, config, add_devices, discovery_info=None):
         return False
 
     # list comprehension: build each pin device from config and pass to add_devices
-    add_devices(buildfunc(pin, arg, config[CONF_HIDE]) for pin, arg in config.get(CONF_PINS).items())
-
-def create_input(pin, arg, hide):
-    dev = BWIOInput(BOARD, pin, arg[0], arg[1], hide) # args = name and sensortype
-    BOARD._inputs.append(dev)
+    add_devices(buildfunc(pin, arg, config) for pin, arg in config.get(CONF_PINS).items())
+
+def create_input(pin, arg, config):
+    dev = BWIOInput(BOARD, pin, arg[0], arg[1], config[CONF_HIDE]) # args = name and sensortype
+    debounce = config[CONF_DEBOUNCE].get(pin)
+    if debounce is not None:
+        dev._filter = BWIOFilter(BOARD, dev, debounce[CONF_MIN_ON], debounce[CONF_MIN_OFF], debounce[CONF_HOLDOFF])
+    BOARD.register(BOARD._inputs, BOARD._lastinput, dev)
     return dev
 
-def create_output(pin, arg, hide):
-    dev = BWIOOutput(BOARD, pin, arg, hide)
-    BOARD._outputs.append(dev)
+def create_output(pin, arg, config):
+    dev = BWIOOutput(BOARD, pin, arg, config[CONF_HIDE])
+    BOARD.register(BOARD._outputs, BOARD._lastoutput, dev)
     return dev
 
 
-class BWIOBoard(serial.threaded.LineReader):
+class BWIOBoard(object):
     """ Representation of an BWIO board. """
 
-    def __init__(self, port):
+    def __init__(self, transport, window=0.02):
         """ Connect to the board. """
-        super(serial.threaded.LineReader, self).__init__()
-        self._inputs = list()
-        self._outputs = list()
-        self._thread = serial.threaded.ReaderThread(serial.Serial(port), self)
-        self._thread.start()
-
-    def __call__(self):
-        """ Force pyserial ReaderThread to just keep using us as the protocol object """
-        return self  
+        self._inputs = dict()      # pin -> BWIOInput
+        self._outputs = dict()     # pin -> BWIOOutput
+        self._lastinput = None     # last reported masks, None until the first report
+        self._lastoutput = None
+        self.suppressed = 0        # entity updates skipped because their bit didn't change
+        self.debouncerate = None   # ms, from the last sampling report
+        self._decoder = BWIODecoder()
+        self.writes = BWIOWriteQueue(self, window)
+        self._transport = transport
+        self._update = transport.update_entity
+        transport.start(self)
+
+    def register(self, devices, lastmask, dev):
+        """ Index the device by pin, seed its state if the board already reported in """
+        devices[dev._pin] = dev
+        if lastmask is not None:
+            dev._state = (lastmask & (1 << dev._pin)) != 0
+            if getattr(dev, '_filter', None) is not None:  # only inputs have one
+                dev._filter.raw = dev._filter.published = dev._state
 
     def ping(self):
         self.ping_input()
@@ -106,46 +142,269 @@ class BWIOBoard(serial.threaded.LineReader):
         self.send("S")
 
     def set_output(self, pin, val):
-        self.send("O%X=%X" % (pin, val))
+        self.writes.queue(pin, val)
 
     def set_debouncerate(self, ms):
-        self.send("S=%X", ms)
+        self.send("S=%X" % ms)
 
     def send(self, data):
         _LOGGER.debug("Sending data (%s)", data)
-        self.write_line(data)
+        self._transport.write_line(data)
 
     def handle_line(self, line):
-        _LOGGER.debug("Received data (%s)", line.strip())
-
-        # Check for input report
-        ins = re.match(r"I=([0-9,A-F]+)", line)
-        if ins is not None:
-            val = int(ins.group(1), 16)
-            for dev in self._inputs:
-                dev._state = (val & (1 << dev._pin)) != 0
-                dev.schedule_update_ha_state()
-
-        # Check for output report
-        outs = re.match(r"O=([0-9,A-F]+)", line)
-        if outs is not None:
-            val = int(outs.group(1), 16)
-            for dev in self._outputs:
-                dev._state = (val & (1 << dev._pin)) != 0
-                dev.schedule_update_ha_state()
-
-        # TODO: check for sampling report (how to set from outside?)
+        if _LOGGER.isEnabledFor(logging.DEBUG):
+            _LOGGER.debug("Received data (%s)", line.strip())
+
+        report = self._decoder.decode(line)
+        if report is None:
+            _LOGGER.warning("Malformed BWIO frame (%r), %d so far", line, self._decoder.malformed)
+        elif type(report) is InputReport:
+            self.dispatch(self._inputs, self._lastinput, report.mask)
+            self._lastinput = report.mask
+        elif type(report) is OutputReport:
+            self.dispatch(self._outputs, self._lastoutput, report.mask)
+            self._lastoutput = report.mask
+            self.writes.confirm(report.mask)
+        elif type(report) is SampleReport:
+            self.debouncerate = report.ms
+
+    def dispatch(self, devices, old, val):
+        """ Only wake the devices whose bit flipped since the last report (all of them on the first) """
+        changed = 0xFFFF if old is None else old ^ val
+        updated = 0
+        while changed:
+            bit = changed & -changed
+            changed ^= bit
+            dev = devices.get(bit.bit_length() - 1)
+            if dev is None:
+                continue
+            if getattr(dev, '_filter', None) is not None:
+                dev._filter.feed((val & bit) != 0)
+            else:
+                dev._state = (val & bit) != 0
+                self._update(dev)
+            updated += 1
+        self.suppressed += len(devices) - updated
 
     def close(self):
         _LOGGER.info("Closing port")
+        self.writes.flush()
+        self._transport.close()
+
+
+class BWIOThreadedTransport(serial.threaded.LineReader):
+    """ pyserial ReaderThread, lines come in on their own thread and hop over to HASS """
+
+    def __init__(self, port):
+        super(serial.threaded.LineReader, self).__init__()
+        self._serial = serial.Serial(port)
+        self._board = None
+        self._thread = None
+
+    def __call__(self):
+        """ Force pyserial ReaderThread to just keep using us as the protocol object """
+        return self
+
+    def start(self, board):
+        self._board = board
+        self._thread = serial.threaded.ReaderThread(self._serial, self)
+        self._thread.start()
+
+    def handle_line(self, line):
+        self._board.handle_line(line)
+
+    def update_entity(self, dev):
+        dev.schedule_update_ha_state()
+
+    def call_later(self, delay, func):
+        timer = threading.Timer(delay, func)
+        timer.daemon = True
+        timer.start()
+        return timer
+
+    def close(self):
         self._thread.close()
 
 
+class BWIOAsyncTransport(object):
+    """ Non-blocking fd reader on the HASS event loop, no thread hop between the board and the entities """
+
+    TERMINATOR = serial.threaded.LineReader.TERMINATOR
+    ENCODING = serial.threaded.LineReader.ENCODING
+
+    def __init__(self, port, loop):
+        self._serial = serial.Serial(port, timeout=0)
+        self._loop = loop
+        self._board = None
+        self._buffer = bytearray()
+
+    def start(self, board):
+        self._board = board
+        self._loop.call_soon_threadsafe(self._loop.add_reader, self._serial.fileno(), self._readable)
+
+    def _readable(self):
+        try:
+            data = self._serial.read(self._serial.in_waiting or 1)
+        except serial.SerialException:
+            _LOGGER.exception("BWIO read failed, no longer reading")
+            self._loop.remove_reader(self._serial.fileno())
+            return
+        self._buffer.extend(data)
+        while self.TERMINATOR in self._buffer:
+            packet, self._buffer = self._buffer.split(self.TERMINATOR, 1)
+            self._board.handle_line(packet.decode(self.ENCODING, 'replace'))
+
+    def update_entity(self, dev):
+        # already on the loop, 0.49 has no async_schedule_update_ha_state so queue the coroutine ourselves
+        dev.hass.async_add_job(dev.async_update_ha_state())
+
+    def write_line(self, text):
+        self._serial.write(text.encode(self.ENCODING, 'replace') + self.TERMINATOR)
+
+    def call_later(self, delay, func):
+        return self._loop.call_later(delay, func)
+
+    def close(self):
+        self._loop.call_soon_threadsafe(self._close)
+
+    def _close(self):
+        self._loop.remove_reader(self._serial.fileno())
+        self._serial.close()
+
+
+class BWIOWriteQueue(object):
+    """
+        Relay writes from a scene or group land within a few ms of each other, hold them for a short
+        window and merge them.  The firmware only takes O<pin>=<val>, not a full mask, so the merge is per
+        pin: the last value queued for a pin wins and pins already in that state aren't written at all.
+    """
+
+    CONFIRM_TIMEOUT = 1.0  # seconds a write counts as in flight, after that queue() goes by the last O= report
+
+    def __init__(self, board, window):
+        self._board = board
+        self._window = window
+        self._lock = threading.Lock()
+        self._sendlock = threading.Lock()  # keeps flushes in order without holding _lock over the serial writes
+        self._timer = None
+        self._pending = dict()   # pin -> (value to write, time first queued)
+        self._awaiting = dict()  # pin -> (value, time queued) until an O= report confirms it
+        self.queued = 0          # calls to queue
+        self.coalesced = 0       # writes that never went out as they were merged or redundant
+        self.latency = None      # seconds from last confirmed command to its O= report
+
+    def queue(self, pin, val):
+        with self._lock:
+            self.queued += 1
+            if pin in self._pending:
+                self.coalesced += 1
+                self._pending[pin] = (val, self._pending[pin][1])
+            else:
+                self._pending[pin] = (val, time.monotonic())
+            if self._window > 0:
+                if self._timer is None:
+                    self._timer = threading.Timer(self._window, self.flush)
+                    self._timer.daemon = True
+                    self._timer.start()
+                return
+        self.flush()
+
+    def flush(self):
+        """ The serial writes happen outside _lock so confirm() on the HASS loop never waits on them """
+        with self._sendlock:
+            with self._lock:
+                lines = self._flushlocked()
+            for line in lines:
+                self._board.send(line)
+
+    def _flushlocked(self):
+        """ Returns the lines to send """
+        if self._timer is not None:
+            self._timer.cancel()
+            self._timer = None
+        lines = []
+        current = self._board._lastoutput
+        for pin, (val, queued) in sorted(self._pending.items()):
+            inflight = self._awaiting.get(pin)
+            if inflight is not None and time.monotonic() - inflight[1] < self.CONFIRM_TIMEOUT:
+                redundant = inflight[0] == val
+            else:
+                redundant = current is not None and bool(current & (1 << pin)) == bool(val)
+            if redundant:
+                self.coalesced += 1
+                continue
+            self._awaiting[pin] = (val, queued)
+            lines.append("O%X=%X" % (pin, val))
+        self._pending.clear()
+        return lines
+
+    def confirm(self, mask):
+        """ Called with each O= report, anything that now matches what we asked for is done """
+        now = time.monotonic()
+        with self._lock:
+            for pin, (val, queued) in list(self._awaiting.items()):
+                if bool(mask & (1 << pin)) == bool(val):
+                    self.latency = now - queued
+                    del self._awaiting[pin]
+
+
+class BWIOFilter(object):
+    """
+        Software debounce for a noisy input, sits between the board reports and the entity.  A new value has
+        to hold for min_on/min_off before it is published and publications are at least holdoff apart, anything
+        that flips back before then never reaches HASS (or the recorder) and is counted as suppressed.
+    """
+
+    def __init__(self, board, dev, min_on, min_off, holdoff):
+        self._board = board
+        self._dev = dev
+        self._min_on = min_on / 1000.0
+        self._min_off = min_off / 1000.0
+        self._holdoff = holdoff / 1000.0
+        self._lock = threading.Lock()
+        self._timer = None
+        self._lastpub = 0
+        self.raw = None         # last value from the board
+        self.published = None   # last value handed to HASS
+        self.suppressed = 0     # transitions that never got published
+
+    def feed(self, state):
+        """ Called with each raw change from the board, on the transport's thread/loop """
+        with self._lock:
+            self.raw = state
+            if self._timer is not None:
+                # a change was waiting to settle and the input moved again
+                self._timer.cancel()
+                self._timer = None
+                self.suppressed += 1
+            if state == self.published:
+                return
+            if self.published is None:
+                delay = 0
+            else:
+                delay = max(self._min_on if state else self._min_off, self._lastpub + self._holdoff - time.monotonic())
+            if delay <= 0:
+                self._publishlocked()
+            else:
+                self._timer = self._board._transport.call_later(delay, self._settle)
+
+    def _settle(self):
+        with self._lock:
+            self._timer = None
+            if self.raw != self.published:
+                self._publishlocked()
+
+    def _publishlocked(self):
+        self.published = self._dev._state = self.raw
+        self._lastpub = time.monotonic()
+        self._board._update(self._dev)
+
+
 class BWIOOutput(SwitchDevice):
     """ Switch interface to an output pin """
 
     def __init__(self, parent, pin, name, hide):
-        _LOGGER.debug("Create %s on output pin %d" % (name, pin))
+        _LOGGER.debug("Create %s on output pin %d", name, pin)
         self._parent = parent
         self._pin = pin
         self._name = name
@@ -170,13 +429,14 @@ class BWIOInput(BinarySensorDevice):
     """ Binary sensor interface to an input pin """
 
     def __init__(self, parent, pin, name, sensortype, hide):
-        _LOGGER.debug("Create %s on input pin %d, type %s" % (name, pin, sensortype))
+        _LOGGER.debug("Create %s on input pin %d, type %s", name, pin, sensortype)
         self._parent = parent
         self._pin = pin
         self._name = name
         self._type = sensortype
         self._hidden = hide
         self._state = None
+        self._filter = None
 
     def update(self):              self._parent.ping_input()
 
@@ -190,4 +450,9 @@ class BWIOInput(BinarySensorDevice):
     def is_on(self):               return self._state != 0
     @property
     def hidden(self):              return self._hidden
+    @property
+    def device_state_attributes(self):
+        if self._filter is None:
+            return None
+        return { 'suppressed': self._filter.suppressed }
 
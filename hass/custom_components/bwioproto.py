@@ -0,0 +1,45 @@
+"""
+ Line protocol spoken by the BWIO board, kept free of HASS imports so it can be benchmarked on its own
+
+   I=XXXX   input mask report (16 bits, hex)
+   O=XXXX   output mask report (16 bits, hex)
+   S=XXXX   sampling/debounce rate report in ms (hex)
+"""
+from collections import namedtuple
+
+InputReport  = namedtuple('InputReport',  'mask')
+OutputReport = namedtuple('OutputReport', 'mask')
+SampleReport = namedtuple('SampleReport', 'ms')
+
+MAX_MASK = 0xFFFF
+
+
+class BWIODecoder(object):
+    """ Turns raw lines into reports, counts the ones we can't make sense of rather than dropping them silently """
+
+    def __init__(self):
+        self.decoded = 0
+        self.malformed = 0
+        # single dispatch on the first character, value is (report type, max value)
+        self._frames = {
+            'I': (InputReport,  MAX_MASK),
+            'O': (OutputReport, MAX_MASK),
+            'S': (SampleReport, None),
+        }
+
+    def decode(self, line):
+        """ Returns a report tuple or None if the line is malformed """
+        frame = self._frames.get(line[:1])
+        if frame is None or line[1:2] != '=':
+            self.malformed += 1
+            return None
+        try:
+            val = int(line[2:], 16)
+        except ValueError:
+            self.malformed += 1
+            return None
+        if val < 0 or (frame[1] is not None and val > frame[1]):
+            self.malformed += 1
+            return None
+        self.decoded += 1
+        return frame[0](val)
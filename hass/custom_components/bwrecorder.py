@@ -0,0 +1,172 @@
+"""
+  Recorder for our chatty entities.  The stock recorder writes an event row plus a state row with the full
+  attribute JSON for every change and commits each one on its own.  For the entities listed here, which
+  should also be in the recorder's exclude list, we keep just the state and the attributes the history and
+  logbook display and write them into the same tables, one transaction per batch.  The logbook only reads
+  the events table so each change still gets a state_changed event, carrying just the new state, and the
+  states rows go in as one multi-row insert pointing at them.
+
+    bwrecorder:
+      db_url: mysql+pymysql://ha:ha@db/ha
+      entities: [ binary_sensor.primary_motion, ... ]
+      batch: 100      # rows, write when this many are waiting
+      interval: 10    # seconds, or when the oldest has waited this long
+"""
+import json
+import logging
+import queue
+import threading
+import time
+import voluptuous as vol
+
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.core import callback
+from homeassistant.helpers.event import track_state_change
+import homeassistant.helpers.config_validation as cv
+import homeassistant.util.dt as dt_util
+
+REQUIREMENTS = ['sqlalchemy>=1.1.11']
+DEPENDENCIES = ['recorder']  # it creates the states table
+DOMAIN = 'bwrecorder'
+
+CONF_DB_URL   = 'db_url'
+CONF_ENTITIES = 'entities'
+CONF_BATCH    = 'batch'
+CONF_INTERVAL = 'interval'
+
+CONFIG_SCHEMA = vol.Schema({
+    DOMAIN: vol.Schema({
+        vol.Required(CONF_DB_URL):   cv.string,
+        vol.Required(CONF_ENTITIES): cv.entity_ids,
+        vol.Optional(CONF_BATCH, default=100):   cv.positive_int,
+        vol.Optional(CONF_INTERVAL, default=10): cv.positive_int
+    })
+}, extra=vol.ALLOW_EXTRA)
+
+# Enough for the history graphs and logbook, everything else stays out of the database
+KEEP_ATTRIBUTES = ('friendly_name', 'unit_of_measurement', 'device_class', 'icon', 'hidden')
+
+INSERT_EVENT = ("INSERT INTO events (event_type, event_data, origin, time_fired, created) "
+                "VALUES ('state_changed', :event_data, 'LOCAL', :last_updated, :created)")
+INSERT_STATE = ("INSERT INTO states (domain, entity_id, state, attributes, event_id, last_changed, last_updated, created) "
+                "VALUES (:domain, :entity_id, :state, :attributes, :event_id, :last_changed, :last_updated, :created)")
+
+_LOGGER = logging.getLogger(__name__)
+
+
+def setup(hass, config):
+    conf = config[DOMAIN]
+    writer = BatchWriter(conf[CONF_DB_URL], conf[CONF_BATCH], conf[CONF_INTERVAL])
+    writer.start()
+
+    @callback
+    def state_change_listener(entity_id, old, new):
+        if new is not None:
+            writer.put(staterow(new))
+
+    track_state_change(hass, conf[CONF_ENTITIES], state_change_listener)
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, lambda e: writer.close())
+    return True
+
+
+def naive(when):
+    """ The recorder keeps UTC without a timezone """
+    return dt_util.as_utc(when).replace(tzinfo=None)
+
+def staterow(state):
+    """ The states row, plus event_data for its event (no old_state, the logbook only looks at new_state) """
+    attributes = {k: v for k, v in state.attributes.items() if k in KEEP_ATTRIBUTES}
+    new_state = { 'entity_id': state.entity_id, 'state': state.state, 'attributes': attributes,
+                  'last_changed': state.last_changed.isoformat(), 'last_updated': state.last_updated.isoformat() }
+    return { 'domain': state.domain, 'entity_id': state.entity_id, 'state': state.state,
+             'attributes': json.dumps(attributes, separators=(',', ':')),
+             'event_data': json.dumps({'entity_id': state.entity_id, 'new_state': new_state}, separators=(',', ':')),
+             'last_changed': naive(state.last_changed), 'last_updated': naive(state.last_updated),
+             'created': naive(dt_util.utcnow()) }
+
+
+class BatchWriter(object):
+    """ Rows queue up for a writer thread, a failed write is kept and retried with the next batch """
+
+    MAX_PENDING = 10000  # past this, drop the oldest rather than grow forever while the database is away
+
+    def __init__(self, db_url, batch, interval):
+        self.batch = batch
+        self.interval = interval
+        self.rows = 0
+        self.batches = 0
+        self.dropped = 0
+        self.elapsed = 0.0
+        self._url = db_url
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._writer, name='bwrecorder', daemon=True)
+
+    def start(self):
+        self._thread.start()
+
+    def put(self, row):
+        self._queue.put(row)
+
+    def close(self):
+        self._queue.put(None)
+        if self._thread.is_alive():
+            self._thread.join()
+
+    def write(self, conn, rows):
+        """
+            One transaction.  Events go in one at a time as each state needs its event_id, the states then go
+            in together as executemany lets the driver send a multi-row insert.
+        """
+        start = time.perf_counter()
+        with conn.begin():
+            for row in rows:
+                row['event_id'] = conn.execute(self._event, row).lastrowid
+            conn.execute(self._state, rows)
+        self.elapsed += time.perf_counter() - start
+        self.rows += 2 * len(rows)
+        self.batches += 1
+
+    def connect(self):
+        from sqlalchemy import create_engine, text
+        self._event = text(INSERT_EVENT)
+        self._state = text(INSERT_STATE)
+        return create_engine(self._url, pool_recycle=3600).connect()
+
+    def _writer(self):
+        conn = None
+        pending = []
+        deadline = None
+        retryat = 0
+        running = True
+        while running:
+            try:
+                row = self._queue.get(timeout=deadline and max(0, deadline - time.monotonic()))
+                if row is None:
+                    running = False
+                else:
+                    pending.append(row)
+                    if deadline is None:
+                        deadline = time.monotonic() + self.interval
+            except queue.Empty:
+                pass
+
+            if not pending or (running and (time.monotonic() < retryat or
+                                            (len(pending) < self.batch and time.monotonic() < deadline))):
+                continue
+            try:
+                if conn is None:
+                    conn = self.connect()
+                self.write(conn, pending)
+                pending = []
+                deadline = None
+                retryat = 0
+            except Exception as e:
+                _LOGGER.warning("Unable to write {} rows, will retry: {}".format(len(pending), e))
+                conn = None
+                deadline = retryat = time.monotonic() + self.interval
+                if len(pending) > self.MAX_PENDING:
+                    self.dropped += len(pending) - self.MAX_PENDING
+                    del pending[:-self.MAX_PENDING]
+
+        if conn is not None:
+            conn.close()
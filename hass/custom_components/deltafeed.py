@@ -0,0 +1,49 @@
+"""
+  Numbered change events for our custom panels, so a label or sensor change sends just that change rather
+  than the whole table.  Changes are collected with change() and go out together from flush() as one bus
+  event:
+
+    {"epoch": 1500000000000, "seq": 12, "changes": [[key..., value], ...], ...extra}
+
+  Every change is a plain set, so applying one twice does no harm.  A panel fetches a snapshot (which
+  carries the epoch and the seq it is current to) when it starts, then applies events in order, fetching a
+  new snapshot if it ever sees a gap.  seq starts over when HASS restarts while an open panel just
+  resubscribes, so epoch (the start time in ms) changing is what tells it to start over then.
+"""
+import threading
+import time
+
+
+class DeltaFeed(object):
+
+    def __init__(self, hass, event_type):
+        self.hass = hass
+        self.event_type = event_type
+        self.epoch = int(time.time() * 1000)
+        self.seq = 0
+        self._pending = dict()
+        self._lock = threading.Lock()
+
+    def change(self, key, value):
+        """ Note a change, a later one to the same key replaces it """
+        with self._lock:
+            self._pending[key] = value
+
+    def flush(self, **extra):
+        """ Send anything noted since the last flush, the lock keeps seq and bus order the same """
+        with self._lock:
+            if not self._pending:
+                return
+            self.seq += 1
+            changes = [list(key) + [value] if isinstance(key, tuple) else [key, value]
+                       for key, value in self._pending.items()]
+            self._pending = dict()
+            self.hass.bus.fire(self.event_type, dict(extra, epoch=self.epoch, seq=self.seq, changes=changes))
+
+    def snapshot(self, getdata):
+        """
+            getdata() along with seq.  seq is read first, and changes are made before they are flushed, so the
+            data is never older than the seq; at worst the panel reapplies a change it already has.
+        """
+        seq = self.seq
+        return dict(getdata(), epoch=self.epoch, seq=seq)
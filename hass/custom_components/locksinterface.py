@@ -9,24 +9,32 @@
     Not sure what can be reused.
 """
 
+import asyncio
 import logging
 import collections
+import heapq
 import operator
+import os
+import sqlite3
+import threading
 import yaml
 import time
 from datetime import datetime, timedelta
 
 import homeassistant.components.zwave.const as zconst
 from homeassistant.components import zwave
+from homeassistant.const import EVENT_HOMEASSISTANT_STOP
+from homeassistant.components.http import HomeAssistantView
 from homeassistant.helpers.entity import Entity
-from homeassistant.helpers.event import track_time_change
+from custom_components.deltafeed import DeltaFeed
 
 from pydispatch import dispatcher
 from openzwave.network import ZWaveNetwork
 
 _LOGGER = logging.getLogger(__name__)
-DEPENDENCIES = ['zwave' ]
+DEPENDENCIES = ['zwave', 'http']
 DOMAIN = 'locksinterface'
+EVENT_DELTA = 'locksinterface_delta'
 
 USER_CODE_STATUS_BYTE   = 8
 NOT_USER_CODE_INDEXES   = (0, 254, 255)  # Enrollment code, refresh and code count
@@ -36,10 +44,11 @@ CODE_UNKNOWN            = "_unknown"
 LOCKSI = None
 
 def setup(hass, config):
-    """ Set up our service call interface, a refresher task that stops itself and hook into the zwave events """
+    """ Set up our service call interface, a refresh scheduler and hook into the zwave events """
     global LOCKSI
     LOCKSI = LocksInterface(hass)
     LOCKSI.schedule_update_ha_state()
+    hass.http.register_view(LocksView(LOCKSI))
 
     hass.services.register(DOMAIN, "setusercode", LOCKSI.set_user_code,
                 { 'description': "Sets a user code on all locks",
@@ -55,7 +64,9 @@ def setup(hass, config):
 
     dispatcher.connect(LOCKSI.value_added, ZWaveNetwork.SIGNAL_VALUE_ADDED) #, weak=False)
     dispatcher.connect(LOCKSI.value_changed, ZWaveNetwork.SIGNAL_VALUE_CHANGED) #, weak=False)
-    track_time_change(hass, LOCKSI.refresh_unknown, second='/5')
+    dispatcher.connect(LOCKSI.refresher.start, ZWaveNetwork.SIGNAL_NETWORK_AWAKED)
+    dispatcher.connect(LOCKSI.refresher.start, ZWaveNetwork.SIGNAL_NETWORK_READY)
+    hass.bus.listen_once(EVENT_HOMEASSISTANT_STOP, lambda e: LOCKSI.store.flush())
     return True
 
 
@@ -63,128 +74,265 @@ class LocksInterface(Entity):
     """ A singleton interface for setting the same code by name on all locks """
     """ Also resort to some hackery to get the available/assigned bit from the ZWave CommandClass """
 
-    CONFIG_NAME = 'locksinterface.yaml'
+    CONFIG_NAME = 'locksinterface.yaml'   # old format, only read to migrate
+    STORE_NAME  = 'locksinterface.db'
 
     def __init__(self, hass):
         self.hass = hass
         self.entity_id = "locksinterface.singleton"
-        self.modtime = 0
-        self.refresh = set()
+        self.feed = DeltaFeed(hass, EVENT_DELTA)     # label changes for the panel
+        self.refresher = RefreshScheduler()
+        self.statusreader = StatusReader()
+        self.zvalues = dict()                        # (node, slot) -> ZWave value
+        self.provisions = dict()                     # (node, slot) -> Provision waiting on that slot
+        self.recent = collections.deque(maxlen=5)    # last few Provisions for the attributes
+        self.byname = collections.defaultdict(set)   # label -> {(node, slot)}
+        self.free = collections.defaultdict(set)     # node -> {slots that are unassigned}
+        self.total = 0                               # number of slots across all locks
+        self._lock = threading.RLock()                # OZW thread, service calls and provision timers all edit the above
+        self.store = LocksStore(self.hass.config.path(LocksInterface.STORE_NAME))
         self.load_state()
 
     @property
     def hidden(self) -> bool:          return True
     @property
-    def state(self) -> str:            return "{} of {}".format(len(self.refresh), sum(len(x) for x in self.values.values()))
+    def state(self) -> str:            return "{} of {}".format(self.refresher.depth, self.total)
     @property
-    def device_state_attributes(self): return { 'values': self.values, 'modtime': self.modtime }  # HASS does shallow change check so we add modtime here
+    def device_state_attributes(self):
+        # Recorded with every change so the labels stay out, the panel gets them from LocksView and the delta feed
+        return { 'rtt': self.refresher.rttms(), 'provisioning': [p.summary() for p in self.recent] }
 
     def load_state(self):
         try:
-            with open(self.hass.config.path(LocksInterface.CONFIG_NAME), 'r') as fp:
-                self.values = yaml.load(fp) or {}
+            self.values = self.store.load()
+            if self.values:
+                self.reindex()
                 return
         except Exception as e:
-            _LOGGER.info("Unable to load old state: {}".format(e), e)
-        self.values = {}
+            _LOGGER.info("Unable to load old state: {}".format(e))
+            self.values = {}
+
+        # First time with the store, bring over anything from the old yaml file
+        oldpath = self.hass.config.path(LocksInterface.CONFIG_NAME)
+        if os.path.exists(oldpath):
+            try:
+                with open(oldpath, 'r') as fp:
+                    self.values = yaml.load(fp) or {}
+                for nodeid, labels in self.values.items():
+                    for index, label in labels.items():
+                        self.store.put(nodeid, index, label)
+                self.store.flush()
+            except Exception as e:
+                _LOGGER.info("Unable to migrate old state: {}".format(e))
+        self.reindex()
+
+    def reindex(self):
+        """ Build the lookup indexes from scratch, after that setlabel keeps them up to date """
+        self.byname.clear()
+        self.free.clear()
+        self.total = 0
+        for nodeid, labels in self.values.items():
+            self.free.setdefault(nodeid, set())
+            for index, label in labels.items():
+                self.index(nodeid, index, label)
+                self.total += 1
+
+    def index(self, nodeid, index, label):
+        self.byname[label].add((nodeid, index))
+        if label == CODE_UNASSIGNED:
+            self.free[nodeid].add(index)
+
+    def unindex(self, nodeid, index, label):
+        slots = self.byname[label]
+        slots.discard((nodeid, index))
+        if not slots:
+            del self.byname[label]
+        self.free[nodeid].discard(index)
+
+    def setlabel(self, nodeid, index, label):
+        """ All label changes come through here so the store and indexes see them """
+        labels = self.values.setdefault(nodeid, dict())
+        old = labels.get(index)
+        if old is None:
+            self.total += 1
+            self.free.setdefault(nodeid, set())
+        else:
+            self.unindex(nodeid, index, old)
+        labels[index] = label
+        self.index(nodeid, index, label)
+        self.store.put(nodeid, index, label)
+        self.feed.change((nodeid, index), label)
 
     def save_state(self):
-        try:
-            with open(self.hass.config.path(LocksInterface.CONFIG_NAME), 'w') as fp:
-                fp.write(yaml.dump(self.values))
-            self.modtime = int(time.time())
-            self.schedule_update_ha_state()
-        except Exception as e:
-            _LOGGER.info("Unable to save state: " + e, e)
+        """ The store writes on its own schedule, send the panel what changed and let HASS know """
+        self.feed.flush()
+        self.schedule_update_ha_state()
 
     def verify_present(self, value):
-        if value.parent_id not in self.values:
-            self.values[value.parent_id] = { value.index: CODE_UNKNOWN }
-        elif value.index not in self.values[value.parent_id]: 
-            self.values[value.parent_id][value.index] = CODE_UNKNOWN
+        if value.index not in self.values.get(value.parent_id, ()):
+            self.setlabel(value.parent_id, value.index, CODE_UNKNOWN)
         else:
             return # Already know this one
         _LOGGER.debug("new user code location {}, {}".format(value.parent_id, value.index))
         self.save_state()
 
+    def labels(self):
+        """ Copy of the labels for the panel """
+        with self._lock:
+            return { nodeid: dict(labels) for nodeid, labels in self.values.items() }
+
     def value_added(self, value):
         """ New ZWave Value added (generally on network start), make note of any user code entries on generic locks """
         if (value.command_class == zconst.COMMAND_CLASS_USER_CODE and value.index not in NOT_USER_CODE_INDEXES):
             _LOGGER.debug("add: {}".format(value))
-            self.verify_present(value)
-            self.refresh.add(value)
+            with self._lock:
+                self.verify_present(value)
+                self.zvalues[(value.parent_id, value.index)] = value
+                self.refresher.add(value, self.priority(value.parent_id, value.index))
 
     def value_changed(self, value):
         """ We got a code update, data is probably just '****' but there is a status byte in the command class """
         if (value.command_class == zconst.COMMAND_CLASS_USER_CODE and value.index not in NOT_USER_CODE_INDEXES):
-            self.verify_present(value)
-            if value in self.refresh:
-                self.refresh.remove(value)
-
-            # PyOZW doesn't expose command class data, we reach into the raw message data and get it ourselves
-            assigned = bool(value.network.manager.getNodeStatistics(value.home_id, value.parent_id)['lastReceivedMessage'][USER_CODE_STATUS_BYTE])
-            current  = self.values[value.parent_id][value.index]
-            _LOGGER.debug("{} code {} assigned {}".format(value.parent_id, value.index, assigned))
-            # Update our label if necessary (don't have one or its no longer set on the lock)
+            with self._lock:
+                self.code_changed(value)
+
+    def code_changed(self, value):
+        """ value_changed for a user code slot, called with the lock held """
+        self.verify_present(value)
+        self.refresher.reply(value)
+
+        assigned = self.statusreader.assigned(value)
+        current  = self.values[value.parent_id][value.index]
+        _LOGGER.debug("{} code {} assigned {}".format(value.parent_id, value.index, assigned))
+        provision = self.provisions.get((value.parent_id, value.index))
+        if provision is not None:
             if not assigned:
-                self.values[value.parent_id][value.index] = CODE_UNASSIGNED
-            elif current == CODE_UNKNOWN:
-                # we didn't load a previous state
-                self.values[value.parent_id][value.index] = "Unnamed Entry {}".format(value.index) 
-            elif current.startswith('_'):
-                # remove the precursor to indicate that it succeeded
-                self.values[value.parent_id][value.index] = current[1:]
-            else:
-                # skip state update as nothing changed
+                return # lock hasn't taken it yet, wait for another report or the timeout
+            self.provision_confirmed(provision, value.parent_id)
+        # Update our label if necessary (don't have one or its no longer set on the lock)
+        if not assigned:
+            if current == CODE_UNASSIGNED:
                 return
-            self.save_state()
-
-    def refresh_unknown(self, now):
-        """
-            We need to query ZWave UserCode values that we don't have any previous state for to see if they
-            are available or occupied.  Using OZW Option RefreshAllUserCodes doesn't always work for me.
-        """
-        for value in self.refresh:
-            # Make a single request now, don't spam zwave network, gets removed when it replies
-            _LOGGER.debug("refresh {},{}".format(value.parent_id, value.index))
-            value.refresh()
+            self.setlabel(value.parent_id, value.index, CODE_UNASSIGNED)
+        elif current == CODE_UNKNOWN:
+            # we didn't load a previous state
+            self.setlabel(value.parent_id, value.index, "Unnamed Entry {}".format(value.index))
+        elif current.startswith('_'):
+            # remove the precursor to indicate that it succeeded
+            self.setlabel(value.parent_id, value.index, current[1:])
+        else:
+            # skip state update as nothing changed
             return
+        self.save_state()
+
+    def priority(self, nodeid, index):
+        """ Slots waiting on a change we made go first, then the ones we know nothing about """
+        label = self.values[nodeid][index]
+        if label == CODE_UNKNOWN:
+            return RefreshScheduler.UNKNOWN
+        if label.startswith('_') and label != CODE_UNASSIGNED:
+            return RefreshScheduler.URGENT
+        return RefreshScheduler.NORMAL
+
+    def confirm(self, nodeid, index):
+        """ Ask the lock to report back a slot we just changed """
+        value = self.zvalues.get((nodeid, index))
+        if value is not None:
+            self.refresher.add(value, RefreshScheduler.URGENT)
 
     def set_user_code(self, service):
         """ Set the ascii number string code to index X on each selected lock """
         newname = service.data.get('newname')
         code = service.data.get('code')
-        locksused = set()
 
         if not all([ord(x) in range(0x30, 0x39+1) for x in code]):
             _LOGGER.error("Invalid code provided to setcode ({})".format(code))
             return
 
-        # Assign to one free space on each lock
-        for nodeid, labels in self.values.items():
-            for index, label in labels.items():
-                if label == CODE_UNASSIGNED:
-                    labels[index] = "_"+newname
-                    self.hass.services.call('lock', 'set_usercode', {'node_id':nodeid, 'code_slot':index, 'usercode':code})
-                    locksused.add(nodeid)
-                    break 
-            
-        self.save_state()
-        locksskipped = self.values.keys() - locksused
+        # Assign to one free space on each lock, all the requests go out together
+        with self._lock:
+            slots = { nodeid: min(free) for nodeid, free in self.free.items() if free }
+            provision = Provision(newname, code, slots)
+            for nodeid, index in slots.items():
+                self.setlabel(nodeid, index, "_"+newname)
+                self.provisions[(nodeid, index)] = provision
+            self.recent.append(provision)
+            self.save_state()
+            locksskipped = self.values.keys() - slots.keys()
+        for nodeid, index in slots.items():
+            self.send_user_code(nodeid, index, code)
+        provision.arm(self.provision_timeout)
+        with self._lock:
+            self.provision_check(provision)
+
         if len(locksskipped) > 0:
             _LOGGER.error("Failed to set the code on the following locks {}".format(locksskipped))
+        return provision
+
+    def send_user_code(self, nodeid, index, code):
+        """ Wait for the set to be handed to OZW so the read-back queues behind it rather than racing it """
+        self.hass.services.call('lock', 'set_usercode', {'node_id':nodeid, 'code_slot':index, 'usercode':code}, blocking=True)
+        self.confirm(nodeid, index)
+
+    def provision_confirmed(self, provision, nodeid):
+        del self.provisions[(nodeid, provision.slots[nodeid])]
+        provision.status[nodeid] = Provision.CONFIRMED
+        self.provision_check(provision)
+
+    def provision_timeout(self, provision):
+        """
+            Resend to any lock that hasn't confirmed.  After the last resend, read the slot back once more on
+            its own in case the confirmation was missed, and only then give up on it and free the slot.
+        """
+        resend, recheck, rollback = [], [], []
+        with self._lock:
+            for nodeid, status in provision.status.items():
+                if status != Provision.PENDING:
+                    continue
+                index = provision.slots[nodeid]
+                if provision.attempts <= Provision.RETRIES:
+                    _LOGGER.warning("No confirmation of {} on lock {}, resending".format(provision.name, nodeid))
+                    resend.append((nodeid, index))
+                elif provision.attempts == Provision.RETRIES + 1:
+                    _LOGGER.warning("No confirmation of {} on lock {}, reading slot {} back".format(provision.name, nodeid, index))
+                    recheck.append((nodeid, index))
+                else:
+                    _LOGGER.error("Lock {} never confirmed {}, rolling back slot {}".format(nodeid, provision.name, index))
+                    del self.provisions[(nodeid, index)]
+                    provision.status[nodeid] = Provision.FAILED
+                    self.setlabel(nodeid, index, CODE_UNASSIGNED)
+                    rollback.append((nodeid, index))
+            if provision.pending:
+                provision.attempts += 1
+                provision.arm(self.provision_timeout)
+            self.provision_check(provision)
+
+        for nodeid, index in resend:
+            self.send_user_code(nodeid, index, provision.code)
+        for nodeid, index in recheck:
+            self.confirm(nodeid, index)
+        for nodeid, index in rollback:
+            self.hass.services.call('lock', 'clear_usercode', {'node_id':nodeid, 'code_slot':index}, blocking=False)
+
+    def provision_check(self, provision):
+        if not provision.pending and provision.finish():
+            _LOGGER.info("Provisioned {} in {:.1f}s: {}".format(provision.name, provision.duration, provision.status))
+            self.save_state()
 
 
     def clear_user_code(self, service):
         """ Clear a code on each lock based on name """
         oldname = service.data.get('oldname')
         _LOGGER.debug("clear code {}".format(oldname))
-        for nodeid, labels in self.values.items():
-            for index, label in labels.items():
-                if label == oldname:
-                    labels[index] = '_'+labels[index]
-                    self.hass.services.call('lock', 'clear_usercode', {'node_id':nodeid, 'code_slot':index})
-        self.save_state()
+        with self._lock:
+            slots = list(self.byname.get(oldname, ()))
+            for nodeid, index in slots:
+                self.setlabel(nodeid, index, '_'+oldname)
+            self.save_state()
+        for nodeid, index in slots:
+            # as with set, the read-back goes in once the clear is with OZW
+            self.hass.services.call('lock', 'clear_usercode', {'node_id':nodeid, 'code_slot':index}, blocking=True)
+            self.confirm(nodeid, index)
 
 
     def rename_user_code(self, service):
@@ -192,9 +340,260 @@ class LocksInterface(Entity):
         oldname = service.data.get('oldname')
         newname = service.data.get('newname')
         _LOGGER.debug("rename {} to {}".format(oldname, newname))
-        for nodeid, labels in self.values.items():
-            for index, label in labels.items():
-                if label == oldname:
-                    labels[index] = newname
-        self.save_state()
+        with self._lock:
+            for nodeid, index in list(self.byname.get(oldname, ())):
+                self.setlabel(nodeid, index, newname)
+            self.save_state()
+
+
+class LocksView(HomeAssistantView):
+    """ Snapshot of the labels and status reader counters for the locks panel, EVENT_DELTA has the changes after seq """
+
+    url = '/api/locksinterface'
+    name = 'api:locksinterface'
+
+    def __init__(self, locksi):
+        self.locksi = locksi
+
+    @asyncio.coroutine
+    def get(self, request):
+        # labels() waits on the lock the OZW thread and provision timers hold, so copy them off the loop
+        snapshot = yield from request.app['hass'].loop.run_in_executor(None, self.snapshot)
+        return self.json(snapshot)
 
+    def snapshot(self):
+        return self.locksi.feed.snapshot(
+                lambda: { 'values': self.locksi.labels(), 'statusreader': self.locksi.statusreader.profile() })
+
+
+class StatusReader(object):
+    """
+        PyOZW doesn't expose command class data, we reach into the raw message data and get it ourselves.
+        getNodeStatistics converts every statistic for the node into a python dict just for us to read one
+        byte.  There's nothing cheaper that changes with each frame (PyOZW 0.4 never sets last_update), and
+        each callback is a new frame anyway, so just count and time the calls for the profile.
+    """
+
+    def __init__(self):
+        self.callbacks = 0     # times asked
+        self.statistics = 0    # times we called getNodeStatistics
+        self.seconds = 0.0     # time spent in getNodeStatistics
+
+    def assigned(self, value):
+        self.callbacks += 1
+        start = time.perf_counter()
+        message = value.network.manager.getNodeStatistics(value.home_id, value.parent_id)['lastReceivedMessage']
+        self.seconds += time.perf_counter() - start
+        self.statistics += 1
+        return bool(message[USER_CODE_STATUS_BYTE])
+
+    def profile(self):
+        return { 'callbacks': self.callbacks, 'statistics': self.statistics, 'ms': int(self.seconds * 1000) }
+
+
+class Provision(object):
+    """ One code going out to a slot on each lock, tracked until every lock reports its slot back as assigned """
+
+    PENDING   = 'pending'
+    CONFIRMED = 'confirmed'
+    FAILED    = 'failed'
+
+    TIMEOUT = 30.0  # seconds to wait for confirmation before resending
+    RETRIES = 2     # resends before giving up on a lock
+
+    def __init__(self, name, code, slots):
+        self.name = name
+        self.code = code
+        self.slots = slots  # node -> slot
+        self.status = { nodeid: Provision.PENDING for nodeid in slots }
+        self.attempts = 1
+        self.started = time.monotonic()
+        self.duration = None
+        self._timer = None
+
+    @property
+    def pending(self):
+        return Provision.PENDING in self.status.values()
+
+    def arm(self, callback):
+        self._timer = threading.Timer(self.TIMEOUT, callback, [self])
+        self._timer.daemon = True
+        self._timer.start()
+
+    def finish(self):
+        """ Returns True the first time it is called """
+        if self.duration is not None:
+            return False
+        self.duration = time.monotonic() - self.started
+        if self._timer is not None:
+            self._timer.cancel()
+        return True
+
+    def summary(self):
+        return { 'name': self.name, 'status': dict(self.status),
+                 'seconds': None if self.duration is None else round(self.duration, 1) }
+
+
+class RefreshScheduler(object):
+    """
+        We need to query ZWave UserCode values that we don't have any previous state for to see if they
+        are available or occupied.  Using OZW Option RefreshAllUserCodes doesn't always work for me.
+
+        Requests go out per node with only a few outstanding at once so we don't spam the zwave network.
+        The next one is sent as soon as a reply comes back, a request without a reply is retried after an
+        exponentially growing wait.  Lower priority numbers go first.
+    """
+
+    URGENT  = 0   # slot touched by a set/clear we are waiting on
+    UNKNOWN = 1   # slot we have no label for
+    NORMAL  = 2
+
+    MAX_INFLIGHT = 1     # outstanding requests per node
+    TIMEOUT      = 10.0  # seconds to wait for a reply
+    BACKOFF      = 5.0   # first retry wait, doubles each time
+    MAX_BACKOFF  = 600.0
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._running = False
+        self._seq = 0
+        self._queues = collections.defaultdict(list)       # node -> heap of (priority, seq, value)
+        self._priority = dict()                            # value -> priority while queued
+        self._inflight = collections.defaultdict(dict)     # node -> {value: (sent time, timeout timer, priority)}
+        self._attempts = collections.Counter()             # value -> times sent without a reply
+        self.rtt = dict()                                  # node -> smoothed round trip seconds
+        self.timeouts = 0
+
+    @property
+    def depth(self):
+        """ Values queued or waiting on a reply """
+        with self._lock:
+            return len(self._priority) + sum(len(x) for x in self._inflight.values())
+
+    def rttms(self):
+        with self._lock:
+            return { node: int(rtt * 1000) for node, rtt in self.rtt.items() }
+
+    def start(self, *args, **kwargs):
+        """ Network is up, start sending """
+        with self._lock:
+            if self._running:
+                return
+            self._running = True
+            for node in list(self._queues):
+                self._pump(node)
+
+    def add(self, value, priority=NORMAL):
+        with self._lock:
+            if value in self._inflight[value.parent_id]:
+                return
+            if value in self._priority and self._priority[value] <= priority:
+                return
+            self._priority[value] = priority
+            self._seq += 1
+            heapq.heappush(self._queues[value.parent_id], (priority, self._seq, value))
+            self._pump(value.parent_id)
+
+    def reply(self, value):
+        """ The node told us about the value, whether we asked or not """
+        with self._lock:
+            node = value.parent_id
+            self._priority.pop(value, None)
+            self._attempts.pop(value, None)
+            entry = self._inflight[node].pop(value, None)
+            if entry is not None:
+                sent, timer, priority = entry
+                timer.cancel()
+                rtt = time.monotonic() - sent
+                self.rtt[node] = rtt if node not in self.rtt else (self.rtt[node] * 0.8 + rtt * 0.2)
+            self._pump(node)
+
+    def _pump(self, node):
+        if not self._running:
+            return
+        queue = self._queues[node]
+        inflight = self._inflight[node]
+        while queue and len(inflight) < self.MAX_INFLIGHT:
+            priority, seq, value = heapq.heappop(queue)
+            if self._priority.get(value) != priority:
+                continue # stale entry, replied to or requeued at a higher priority
+            del self._priority[value]
+            self._attempts[value] += 1
+            timer = threading.Timer(self.TIMEOUT, self._timeout, [value])
+            timer.daemon = True
+            inflight[value] = (time.monotonic(), timer, priority)
+            timer.start()
+            _LOGGER.debug("refresh {},{} (attempt {})".format(value.parent_id, value.index, self._attempts[value]))
+            value.refresh()
+
+    def _timeout(self, value):
+        with self._lock:
+            entry = self._inflight[value.parent_id].pop(value, None)
+            if entry is None:
+                return
+            self.timeouts += 1
+            wait = min(self.BACKOFF * 2 ** (self._attempts[value] - 1), self.MAX_BACKOFF)
+            _LOGGER.debug("no reply for {},{}, retry in {}s".format(value.parent_id, value.index, wait))
+            retry = threading.Timer(wait, self.add, [value, entry[2]])
+            retry.daemon = True
+            retry.start()
+            self._pump(value.parent_id)
+
+
+class LocksStore(object):
+    """
+        sqlite table keyed by (node, slot) so a label change is a single row, not a rewrite of everything.
+        Changes are collected and written together a little later on a timer thread, so a burst of
+        value updates at network start turns into one transaction off the zwave/HASS threads.
+    """
+
+    DELAY = 2.0  # seconds to collect changes before writing
+
+    def __init__(self, path):
+        self._path = path
+        self._lock = threading.Lock()
+        self._pending = dict()
+        self._timer = None
+
+    def _connect(self):
+        # connections are per thread in sqlite3, we're called from a few so just make one each time
+        conn = sqlite3.connect(self._path)
+        conn.execute("CREATE TABLE IF NOT EXISTS labels (node INTEGER, slot INTEGER, label TEXT, PRIMARY KEY (node, slot))")
+        return conn
+
+    def load(self):
+        values = dict()
+        conn = self._connect()
+        try:
+            for node, slot, label in conn.execute("SELECT node, slot, label FROM labels"):
+                values.setdefault(node, dict())[slot] = label
+        finally:
+            conn.close()
+        return values
+
+    def put(self, node, slot, label):
+        with self._lock:
+            self._pending[(node, slot)] = label
+            if self._timer is None:
+                self._timer = threading.Timer(self.DELAY, self.flush)
+                self._timer.daemon = True
+                self._timer.start()
+
+    def flush(self):
+        with self._lock:
+            if self._timer is not None:
+                self._timer.cancel()
+                self._timer = None
+            pending, self._pending = self._pending, dict()
+        if not pending:
+            return
+        try:
+            conn = self._connect()
+            try:
+                with conn:
+                    conn.executemany("INSERT OR REPLACE INTO labels (node, slot, label) VALUES (?, ?, ?)",
+                                     [(node, slot, label) for (node, slot), label in pending.items()])
+            finally:
+                conn.close()
+        except Exception as e:
+            _LOGGER.error("Unable to save lock labels: {}".format(e))
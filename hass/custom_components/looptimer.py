@@ -0,0 +1,51 @@
+"""
+  One shot timers that run off the event loop's own clock.  In 0.49 the track_point_in_time helpers are
+  driven by the once a second time_changed event, so they fire up to a second late and keep a bus listener
+  attached for as long as they wait.  These take the same arguments and return the same cancel function.
+"""
+import homeassistant.util.dt as dt_util
+
+
+def track_point_in_utc_time(hass, action, point_in_time):
+    """ Run action(point_in_time) at point_in_time, returns a function that cancels it """
+    return LoopTimer(hass, action, point_in_time).cancel
+
+# aware datetimes compare the same whatever their zone
+track_point_in_time = track_point_in_utc_time
+
+
+class LoopTimer(object):
+    """ Can be created and cancelled from any thread, the loop handle is only touched on the loop """
+
+    def __init__(self, hass, action, when):
+        self._hass = hass
+        self._action = action
+        self._when = when
+        self._handle = None
+        self._cancelled = False
+        hass.loop.call_soon_threadsafe(self._schedule)
+
+    def _schedule(self):
+        if self._cancelled:
+            return
+        delay = (self._when - dt_util.utcnow()).total_seconds()
+        self._handle = self._hass.loop.call_later(max(0, delay), self._fire)
+
+    def _fire(self):
+        self._handle = None
+        if self._cancelled:
+            return
+        if dt_util.utcnow() < self._when:
+            # the loop clock and wall clock can disagree by a hair, don't run early
+            self._schedule()
+            return
+        self._hass.async_add_job(self._action, self._when)
+
+    def cancel(self):
+        self._cancelled = True
+        self._hass.loop.call_soon_threadsafe(self._unschedule)
+
+    def _unschedule(self):
+        if self._handle is not None:
+            self._handle.cancel()
+            self._handle = None
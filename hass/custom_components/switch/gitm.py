@@ -1,29 +1,47 @@
 """
  Ghost in the machine, move around the house and turn things off/on
+
+ Each occupant has a list of windows, times they are in a room with the lights on.  Each day every window
+ is shifted by up to +/- jitter minutes, its length varied by +/- vary minutes and skipped altogether if
+ the chance roll fails.  With learn set, rooms with recorder history instead replay a random day from
+ the last N days of their lights.  A room is lit when any occupant is in it.
+
+ The day's plan is worked out once and a timer set for each minute something changes.  Each tick sends
+ one turn_on and one turn_off per domain for just the lights that change, based on what we last asked
+ for rather than reading back states that may be stale.
 """
 import logging
+from collections import defaultdict
 from datetime import timedelta as td
-from random import uniform
+from random import choice, random, uniform
 import voluptuous as vol
 
-from homeassistant.const import EVENT_STATE_CHANGED, STATE_ALARM_ARMED_AWAY, STATE_ON, STATE_OFF
-from homeassistant.components.sun import STATE_ATTR_NEXT_SETTING
-from homeassistant.helpers.event import track_point_in_time, track_utc_time_change
-from homeassistant.util.dt import now
+from homeassistant.const import STATE_ALARM_ARMED_AWAY, STATE_ON, ATTR_ENTITY_ID, SERVICE_TURN_ON, SERVICE_TURN_OFF
+from homeassistant.helpers.event import track_state_change
+from homeassistant.util.dt import now, start_of_local_day, as_local
 import homeassistant.components.switch as switch
 import homeassistant.helpers.config_validation as cv
+from custom_components.looptimer import track_point_in_time
 
-DEPENDENCIES = ['sun']
 _LOGGER = logging.getLogger(__name__)
 
+LEARN_JITTER = 10  # minutes to shift a replayed day by
+
+WINDOW_SCHEMA = vol.Schema({
+    vol.Required('room'):             cv.string,
+    vol.Required('start'):            cv.time_period,
+    vol.Required('end'):              cv.time_period,
+    vol.Optional('jitter', default=20): vol.Coerce(float),
+    vol.Optional('vary',   default=3):  vol.Coerce(float),
+    vol.Optional('chance', default=1.0): vol.All(vol.Coerce(float), vol.Range(min=0, max=1))
+})
+
 PLATFORM_SCHEMA = vol.Schema({
     'platform':                 'gitm',
-    vol.Required('wakeup'):     cv.time_period,
-    vol.Required('tvtime'):     cv.time_period,
-    vol.Required('bedtime'):    cv.time_period,
     vol.Required('alarm'):      cv.entity_id,
-    vol.Required('bedroom'):    cv.entity_id,
-    vol.Required('downstairs'): cv.entity_id
+    vol.Required('rooms'):      {cv.string: cv.entity_ids},
+    vol.Required('occupants'):  [[WINDOW_SCHEMA]],
+    vol.Optional('learn', default=0): cv.positive_int
 })
 
 
@@ -40,16 +58,28 @@ class Ghost(switch.SwitchDevice):
         self.hass = hass
         self.active = False
         self.today = now().day - 1
-        self.times = {}
-        # Sun provides a nice heartbeat for this process
-        self.hass.bus.async_listen(EVENT_STATE_CHANGED, self.state_change_listener)
+        self.periods = {}    # room: [(on, off), ...] for today
+        self.learned = {}    # room: [[(on offset, off offset), ...] per day]
+        self.commanded = {}  # entity_id: what we last asked for
+        self.timers = []
+
+        for occupant in self.occupants:
+            for window in occupant:
+                if window['room'] not in self.rooms:
+                    _LOGGER.error("Ghost window for unknown room {}, ignoring".format(window['room']))
+
+        # the alarm turns us on/off
+        track_state_change(self.hass, [self.alarm], self.state_change_listener)
 
     def turn_on(self, **kwargs):
         self.active = True
+        self.commanded = {}
         self.schedule_update_ha_state()
+        self.schedule()
 
     def turn_off(self, **kwargs):
         self.active = False
+        self.cancel()
         self.schedule_update_ha_state()
 
     @property
@@ -59,55 +89,133 @@ class Ghost(switch.SwitchDevice):
     @property
     def is_on(self):               return self.active
     @property
-    def device_state_attributes(self): 
-        keys = sorted(self.times.keys())
-        return {k: self.times[k].strftime("%H:%M:%S") for k in keys}
-        
-    def state_change_listener(self, event):
-        state = event.data.get('new_state', None)
+    def device_state_attributes(self):
+        ret = {}
+        for room in sorted(self.periods):
+            ret[room] = ", ".join("{}-{}".format(on.strftime("%H:%M"), off.strftime("%H:%M")) for on, off in self.periods[room])
+        if self.learned:
+            ret['learned'] = sorted(self.learned)
+        return ret
+
+    def state_change_listener(self, entity_id, old, state):
         if state is None:
             return
 
-        elif state.entity_id == 'sun.sun' and self.is_on: # Sun update
-            self.updatestates(state)
+        elif entity_id == self.alarm: # turn on/off based on alarm
+            if state.state == STATE_ALARM_ARMED_AWAY:
+                self.turn_on()
+            else:
+                self.turn_off()
 
-        elif state.entity_id == self.entity_id and self.is_on: # we turned on
-            self.updatestates(self.hass.states.get('sun.sun'))
 
-        elif state.entity_id == self.alarm: # turn on/off based on alarm
-            self.active = (state.state == STATE_ALARM_ARMED_AWAY)
-            self.schedule_update_ha_state()
-
-        
-    def updatestates(self, sunstate):
+    def schedule(self):
+        """ Work out today's plan if needed and set a timer for each tick still to come, plus midnight """
+        self.cancel()
         cur = now()
         if cur.day != self.today: # new day, setup new times
-            nextset = sunstate.attributes[STATE_ATTR_NEXT_SETTING]
-            midnight = cur.replace(hour=0, minute=0, second=0, microsecond=0)
-
-            self.times['1. wake']  = midnight + self.wakeup  + td(minutes=uniform(-20, +20))
-            self.times['2. leave'] = self.times['1. wake'] + td(minutes=20) + td(minutes=uniform(-3,3))
-
-            self.times['3. tv']    = midnight + self.tvtime  + td(minutes=uniform(-20, +20))
-            self.times['4. bed']   = midnight + self.bedtime + td(minutes=uniform(-20, +20))
-            self.times['5. sleep'] = self.times['4. bed'] + td(minutes=uniform(10,15))
-
+            midnight = start_of_local_day(cur.date())
+            if self.learn:
+                self.learnhistory(midnight)
+            self.periods = self.plan(midnight)
             self.today = cur.day
             self.schedule_update_ha_state()
-            _LOGGER.debug("Set new times sunset: {} {}".format(nextset, self.device_state_attributes))
-
-        # times occur as wake [bed] leave [none] tv [liv] step [none] bed [bed] sleep [none]
-        bed = liv = STATE_OFF
-        if   cur > self.times['5. sleep']: pass
-        elif cur > self.times['4. bed']:   bed = STATE_ON
-        elif cur > self.times['3. tv']:    liv = STATE_ON
-        elif cur > self.times['2. leave']: pass
-        elif cur > self.times['1. wake']:  bed = STATE_ON
-
-        if self.hass.states.get(self.bedroom).state != bed:
-            _LOGGER.debug("toggle bedroom")
-            switch.toggle(self.hass, self.bedroom)
-        if self.hass.states.get(self.downstairs).state != liv:
-            _LOGGER.debug("toggle living room")
-            switch.toggle(self.hass, self.downstairs)
-
+            _LOGGER.debug("Set new times {}".format(self.device_state_attributes))
+
+        ticks = set()
+        for periods in self.periods.values():
+            for on, off in periods:
+                ticks.update((on, off))
+        for when in sorted(ticks):
+            if when > cur:
+                self.timers.append(track_point_in_time(self.hass, self.tick, when))
+        self.timers.append(track_point_in_time(self.hass, self.newday, start_of_local_day(cur.date() + td(days=1))))
+        self.updatestates(cur)
+
+    def cancel(self):
+        for remove in self.timers:
+            remove()
+        self.timers = []
+
+    def tick(self, when):
+        if self.active:
+            self.updatestates(now())
+
+    def newday(self, when):
+        if self.active:
+            self.schedule()
+
+    def plan(self, midnight):
+        """ Today's on periods for each room, rounded to the minute so things that line up share a tick """
+        def minute(t):
+            return t.replace(second=0, microsecond=0)
+
+        periods = defaultdict(list)
+        for room, days in self.learned.items():
+            shift = td(minutes=uniform(-LEARN_JITTER, LEARN_JITTER))
+            for on, off in choice(days):
+                periods[room].append((minute(midnight + on + shift), minute(midnight + off + shift)))
+
+        for occupant in self.occupants:
+            for w in occupant:
+                if w['room'] not in self.rooms or w['room'] in self.learned or random() > w['chance']:
+                    continue
+                on  = midnight + w['start'] + td(minutes=uniform(-w['jitter'], w['jitter']))
+                off = on + (w['end'] - w['start']) + td(minutes=uniform(-w['vary'], w['vary']))
+                on, off = minute(on), minute(off)
+                if off > on:
+                    periods[w['room']].append((on, off))
+
+        return {room: sorted(p) for room, p in periods.items()}
+
+    def learnhistory(self, midnight):
+        """ Each room's on periods for each of the last few days from the recorder, where there is any """
+        from homeassistant.components.history import state_changes_during_period
+        self.learned = {}
+        start = midnight - td(days=self.learn)
+        for room, lights in self.rooms.items():
+            days = defaultdict(list)
+            seen = False
+            for eid in lights:
+                try:
+                    states = state_changes_during_period(self.hass, start, midnight, eid).get(eid, [])
+                except Exception as e:
+                    _LOGGER.warning("Unable to read history for {}: {}".format(eid, e))
+                    continue
+                seen = seen or bool(states)
+                lit = None
+                for state in states + [None]:
+                    when = state and as_local(state.last_changed) or midnight
+                    if lit is not None:
+                        self.split(days, start, lit, when)
+                        lit = None
+                    if state is not None and state.state == STATE_ON:
+                        lit = when
+            if seen:
+                self.learned[room] = [sorted(days[ii]) for ii in range(self.learn)]
+
+    @staticmethod
+    def split(days, start, on, off):
+        """ Add an on period to days[n] as offsets from that day's midnight, splitting over midnight """
+        while on < off:
+            day = (on - start).days
+            daystart = start + td(days=day)
+            end = min(off, daystart + td(days=1))
+            days[day].append((on - daystart, end - daystart))
+            on = end
+
+    def updatestates(self, cur):
+        """ Ask for the lights that should change at cur, one call per domain and service """
+        want = {}
+        for room, lights in self.rooms.items():
+            lit = any(on <= cur < off for on, off in self.periods.get(room, ()))
+            for eid in lights:
+                want[eid] = want.get(eid, False) or lit
+
+        batch = defaultdict(list)
+        for eid, lit in want.items():
+            if self.commanded.get(eid) != lit:
+                batch[(eid.split('.')[0], lit and SERVICE_TURN_ON or SERVICE_TURN_OFF)].append(eid)
+        for (domain, service), eids in batch.items():
+            _LOGGER.debug("{}.{} {}".format(domain, service, eids))
+            self.hass.services.call(domain, service, {ATTR_ENTITY_ID: sorted(eids)})
+        self.commanded = want
@@ -1,58 +1,477 @@
 #!/usr/bin/env python3
+"""
+ Plays sounds for HASS over MQTT, switches/set/<sound> ON/OFF with the state echoed on switches/pub/<sound>.
+ Every wav in sounds/ is decoded into memory at startup so a play never waits on the disk.  The MQTT client
+ is driven from an asyncio loop and backends never block, so a stop is never stuck behind a long sound.
 
+   ./soundserver.py [--backend nssound|mixer|file|null] [--sink out.raw] [--player cmd] [--voices 8] [--broker host] [--port 1883]
+"""
+import argparse
+import asyncio
+import collections
 import glob
+import io
 import os
+import shlex
+import subprocess
+import sys
+import threading
 import time
+import wave
 import yaml
 
 import paho.mqtt.client as mqtt
-from AppKit import NSSound
+try:
+    import numpy as np
+except ImportError:
+    np = None  # only the mixer needs it
 
-sounds = dict()
-basedir = os.path.dirname(__file__)
+basedir = os.path.dirname(os.path.abspath(__file__))
 
-def load_sound(name, loop=False):
-    f = os.path.join(basedir, 'sounds', name+'.wav')
-    sounds[name] = NSSound.alloc()
-    sounds[name].initWithContentsOfFile_byReference_(f, True)
-    if loop:
-        sounds[name].setLoops_(True)
+# What the mixer pipes its 16 bit stereo PCM to when it isn't writing a file, sox's play on the Mac
+PLAYER = {
+    'darwin': 'play -q -t raw -r 44100 -e signed -b 16 -c 2 -',
+    'linux':  'aplay -q -t raw -f S16_LE -r 44100 -c 2',
+}.get(sys.platform)
 
-def on_connect(client, userdata, flags, rc):
-    client.subscribe("switches/set/#")
+# How each sound plays, anything not listed plays once at full volume and priority 0
+SETTINGS = {
+    'warning':  {'loop': True, 'priority': 1},
+    'doorbell': {'priority': 2},
+}
 
-def on_message(client, userdata, msg):
-    if msg.topic.startswith('switches/set/'):
-        sound = msg.topic[13:]
-        if sound not in sounds:
+
+class Sound(object):
+    """ A wav file decoded to PCM """
+
+    def __init__(self, path):
+        self.name = os.path.splitext(os.path.basename(path))[0]
+        settings = SETTINGS.get(self.name, {})
+        self.loop = settings.get('loop', False)
+        self.priority = settings.get('priority', 0)
+        self.volume = settings.get('volume', 1.0)
+        with wave.open(path, 'rb') as w:
+            self.channels = w.getnchannels()
+            self.width = w.getsampwidth()
+            self.rate = w.getframerate()
+            self.pcm = w.readframes(w.getnframes())
+
+    @property
+    def framesize(self): return self.channels * self.width
+    @property
+    def duration(self):  return len(self.pcm) / self.framesize / self.rate
+
+    def wavbytes(self):
+        """ The PCM wrapped back up as an in memory wav for backends that want a file format """
+        out = io.BytesIO()
+        with wave.open(out, 'wb') as w:
+            w.setnchannels(self.channels)
+            w.setsampwidth(self.width)
+            w.setframerate(self.rate)
+            w.writeframes(self.pcm)
+        return out.getvalue()
+
+
+def load_sounds(directory):
+    sounds = dict()
+    for path in sorted(glob.glob(os.path.join(directory, '*.wav'))):
+        sound = Sound(path)
+        sounds[sound.name] = sound
+    return sounds
+
+
+class Backend(object):
+    """
+        Something that can play a Sound.  play and stop must return straight away, first_frame(name) is
+        called as the first frame of each play is handed to the output.
+    """
+
+    def __init__(self):
+        self.first_frame = lambda name: None
+
+    def prepare(self, sounds):
+        """ Called once with all the sounds before anything is played """
+        pass
+
+    def play(self, sound):
+        """ Start the sound from the beginning, restarting it if it is already playing """
+
+    def stop(self, sound):
+        """ Stop the sound if it is playing """
+
+    def close(self):
+        pass
+
+
+class NullBackend(Backend):
+    """ Plays everything instantly into nothing, for testing """
+
+    def __init__(self):
+        super().__init__()
+        self.playing = set()
+
+    def play(self, sound):
+        self.playing.add(sound.name)
+        self.first_frame(sound.name)
+
+    def stop(self, sound):
+        self.playing.discard(sound.name)
+
+
+class FileBackend(Backend):
+    """ Writes raw PCM to a file in real time, a period at a time, one thread per playing sound """
+
+    PERIOD = 0.01  # seconds per write
+
+    def __init__(self, path):
+        super().__init__()
+        self._fp = open(path, 'wb')
+        self._lock = threading.Lock()
+        self._playing = dict()
+
+    def play(self, sound):
+        self.stop(sound)
+        done = threading.Event()
+        self._playing[sound.name] = done
+        threading.Thread(target=self._write, args=(sound, done), name='play-'+sound.name, daemon=True).start()
+
+    def stop(self, sound):
+        done = self._playing.pop(sound.name, None)
+        if done is not None:
+            done.set()
+
+    def close(self):
+        for done in self._playing.values():
+            done.set()
+        with self._lock:
+            self._fp.close()
+
+    def _write(self, sound, done):
+        chunk = int(sound.rate * self.PERIOD) * sound.framesize
+        first = True
+        start = time.perf_counter()
+        written = 0
+        while not done.is_set():
+            for offset in range(0, len(sound.pcm), chunk):
+                if done.is_set():
+                    return
+                with self._lock:
+                    if self._fp.closed:
+                        return
+                    self._fp.write(sound.pcm[offset:offset+chunk])
+                if first:
+                    self.first_frame(sound.name)
+                    first = False
+                written += self.PERIOD
+                wait = start + written - time.perf_counter()
+                if wait > 0:
+                    time.sleep(wait)
+            if not sound.loop:
+                break
+
+
+class NSSoundBackend(Backend):
+    """ macOS, NSSound objects built from the in memory wav data rather than by reference to the file """
+
+    def __init__(self):
+        super().__init__()
+        self._sounds = dict()
+
+    def prepare(self, sounds):
+        from AppKit import NSSound, NSData
+        for name, sound in sounds.items():
+            data = sound.wavbytes()
+            ns = NSSound.alloc().initWithData_(NSData.dataWithBytes_length_(data, len(data)))
+            ns.setLoops_(sound.loop)
+            self._sounds[name] = ns
+
+    def play(self, sound):
+        ns = self._sounds[sound.name]
+        ns.stop()
+        ns.play()
+        self.first_frame(sound.name)
+
+    def stop(self, sound):
+        self._sounds[sound.name].stop()
+
+
+class Voice(object):
+    __slots__ = ('sound', 'samples', 'pos', 'started')
+
+    def __init__(self, sound, samples, started):
+        self.sound = sound
+        self.samples = samples
+        self.pos = 0
+        self.started = started
+
+
+class MixerBackend(Backend):
+    """
+        Mixes up to N sounds in software and pipes the result as 16 bit stereo PCM to a player command (or
+        writes it to a file when given one) in real time.  play and stop only append to a deque, which needs no lock between the MQTT and mixer
+        threads, and the mixer picks them up at the start of each period.  With every voice busy a new sound
+        takes over the lowest priority, oldest voice, as long as that isn't a higher priority than itself.
+        Voices under a higher priority sound are ducked.
+    """
+
+    RATE   = 44100
+    PERIOD = 0.01   # seconds mixed at a time
+    DUCK   = 0.3    # gain for voices under a higher priority sound
+
+    def __init__(self, path=None, voices=8, player=PLAYER):
+        super().__init__()
+        if np is None:
+            raise RuntimeError("The mixer backend needs numpy")
+        if path is None and player is None:
+            raise RuntimeError("The mixer backend needs a player command or an output file")
+        self.voices = [None] * voices
+        self.commands = collections.deque()
+        self.preempted = 0
+        self.dropped = 0
+        self._samples = dict()
+        self._clock = 0       # frames mixed so far
+        self._started = []    # names to call first_frame for after this period is written
+        self._path = path
+        self._player = player
+        self._proc = None
+        self._fp = None
+        self._running = False
+        self._thread = threading.Thread(target=self._run, name='mixer', daemon=True)
+
+    def prepare(self, sounds):
+        self.load(sounds)
+        if self._path:
+            self._fp = open(self._path, 'wb')
+        else:
+            self._proc = subprocess.Popen(shlex.split(self._player), stdin=subprocess.PIPE)
+            self._fp = self._proc.stdin
+        self._running = True
+        self._thread.start()
+
+    def load(self, sounds):
+        """ Convert each sound to float32 stereo at our rate once, up front """
+        for name, sound in sounds.items():
+            dtype = {1: np.uint8, 2: '<i2', 4: '<i4'}[sound.width]
+            data = np.frombuffer(sound.pcm, dtype=dtype).reshape(-1, sound.channels).astype(np.float32)
+            if sound.width == 1:
+                data = (data - 128) / 128
+            else:
+                data /= float(1 << (8*sound.width - 1))
+            if sound.channels == 1:
+                data = np.repeat(data, 2, axis=1)
+            data = data[:, :2]
+            if sound.rate != self.RATE:
+                x = np.linspace(0, len(data)-1, int(len(data) * self.RATE / sound.rate))
+                data = np.stack([np.interp(x, np.arange(len(data)), data[:, c]) for c in (0, 1)], axis=1)
+            self._samples[name] = np.ascontiguousarray(data, dtype=np.float32)
+
+    def play(self, sound):
+        self.commands.append((True, sound))
+
+    def stop(self, sound):
+        self.commands.append((False, sound))
+
+    def close(self):
+        self._running = False
+        if self._thread.is_alive():
+            self._thread.join()
+        if self._fp:
+            try:
+                self._fp.close()
+            except OSError:
+                pass
+        if self._proc:
+            self._proc.wait()
+
+    def mix(self, frames):
+        """ Apply any waiting commands and return the next frames as int16 stereo """
+        while self.commands:
+            start, sound = self.commands.popleft()
+            self._stopvoice(sound)
+            if start:
+                self._startvoice(sound)
+
+        out = np.zeros((frames, 2), dtype=np.float32)
+        top = max((v.sound.priority for v in self.voices if v is not None), default=0)
+        for ii, v in enumerate(self.voices):
+            if v is None:
+                continue
+            end = v.pos + frames
+            if end <= len(v.samples):
+                chunk = v.samples[v.pos:end]
+            elif v.sound.loop:
+                chunk = np.take(v.samples, np.arange(v.pos, end), axis=0, mode='wrap')
+            else:
+                chunk = v.samples[v.pos:]
+            v.pos = end % len(v.samples) if v.sound.loop else end
+            if v.pos >= len(v.samples):
+                self.voices[ii] = None
+            gain = v.sound.volume * (self.DUCK if v.sound.priority < top else 1.0)
+            out[:len(chunk)] += chunk * gain
+
+        self._clock += frames
+        np.clip(out, -1.0, 1.0, out=out)
+        return (out * 32767).astype('<i2')
+
+    def _stopvoice(self, sound):
+        for ii, v in enumerate(self.voices):
+            if v is not None and v.sound is sound:
+                self.voices[ii] = None
+
+    def _startvoice(self, sound):
+        samples = self._samples.get(sound.name)
+        if samples is None or not len(samples):
             return
-        if msg.payload == b'ON':
-            sounds[sound].play()
-            client.publish('switches/pub/'+sound, 'ON')
+        free = [ii for ii, v in enumerate(self.voices) if v is None]
+        if free:
+            slot = free[0]
         else:
-            sounds[sound].stop()
-            client.publish('switches/pub/'+sound, 'OFF')
-
-while True:
-    try:
-        # Find out where the config files are and load our HASS api password
-        with open(os.path.join(basedir, 'secrets.yaml'), 'r') as fp:
-            config = yaml.load(fp)
-            pw = config['http_password']
-
-        # Now load any sounds we want
-        load_sound('warning', True)
-        load_sound('doorbell', False)
-
-        # And start of the MQTT connection through the docker-machine
-        client = mqtt.Client("sound-client")
-        client.username_pw_set('homeassistant', pw)
-        client.on_connect = on_connect
-        client.on_message = on_message
-        client.connect("192.168.99.100")
-        client.loop_forever()
-    except Exception as e:
-        print("Connection died because of " + e)
-        time.sleep(5)
+            slot = min(range(len(self.voices)), key=lambda ii: (self.voices[ii].sound.priority, self.voices[ii].started))
+            if self.voices[slot].sound.priority > sound.priority:
+                self.dropped += 1
+                return
+            self.preempted += 1
+        self.voices[slot] = Voice(sound, samples, self._clock)
+        self._started.append(sound.name)
+
+    def _run(self):
+        frames = int(self.RATE * self.PERIOD)
+        start = time.perf_counter()
+        periods = 0
+        while self._running:
+            block = self.mix(frames)
+            if self._fp:
+                try:
+                    self._fp.write(block.tobytes())
+                except OSError as e:
+                    # keep mixing so the switches still work, just without sound
+                    print("Mixer output failed because of {}".format(e))
+                    self._fp = None
+            for name in self._started:
+                self.first_frame(name)
+            self._started = []
+            periods += 1
+            wait = start + periods*self.PERIOD - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+
+
+BACKENDS = {
+    'nssound': lambda args: NSSoundBackend(),
+    'mixer':   lambda args: MixerBackend(args.sink, args.voices, args.player),
+    'file':    lambda args: FileBackend(args.sink),
+    'null':    lambda args: NullBackend(),
+}
+
+
+class SoundServer(object):
+    """
+        Maps MQTT switch commands onto the backend.  One client with a persistent session (clean_session off)
+        lives for the whole run, so QoS 1 commands sent while we are reconnecting are queued by the broker
+        rather than lost.  The retained switches/pub state is republished on every connect.
+    """
+
+    MIN_BACKOFF = 0.5
+    MAX_BACKOFF = 60
+
+    def __init__(self, sounds, backend, loop):
+        self.sounds = sounds
+        self.backend = backend
+        self.loop = loop
+        self.state = {name: 'OFF' for name in sounds}
+        self.connected = False
+        backend.prepare(sounds)
+
+    def on_connect(self, client, userdata, flags, rc):
+        if rc != 0:
+            print("Connection refused: {}".format(mqtt.connack_string(rc)))
+            return
+        self.connected = True
+        client.subscribe("switches/set/#", qos=1)
+        for name, state in self.state.items():
+            client.publish('switches/pub/'+name, state, qos=1, retain=True)
+
+    def on_message(self, client, userdata, msg):
+        if msg.topic.startswith('switches/set/'):
+            sound = self.sounds.get(msg.topic[13:])
+            if sound is None:
+                return
+            if msg.payload == b'ON':
+                self.backend.play(sound)
+                self.state[sound.name] = 'ON'
+            else:
+                self.backend.stop(sound)
+                self.state[sound.name] = 'OFF'
+            client.publish('switches/pub/'+sound.name, self.state[sound.name], qos=1, retain=True)
+
+    def client(self, password):
+        client = mqtt.Client("sound-client", clean_session=False)
+        client.username_pw_set('homeassistant', password)
+        client.on_connect = self.on_connect
+        client.on_message = self.on_message
+        return client
+
+    async def run(self, client, host, port=1883):
+        """ Keep the client connected, retrying straight away and then backing off while it keeps failing """
+        delay = 0
+        while True:
+            self.connected = False
+            try:
+                await self.session(client, host, port)
+            except (OSError, ConnectionError) as e:
+                print("Connection died because of {}".format(e))
+            if self.connected:
+                delay = 0
+            else:
+                delay = min(max(delay * 2, self.MIN_BACKOFF), self.MAX_BACKOFF)
+            await asyncio.sleep(delay)
+
+    async def session(self, client, host, port=1883):
+        """ Connect and service the client from our loop until the connection drops """
+        await self.loop.run_in_executor(None, client.connect, host, port)
+
+        lost = self.loop.create_future()
+        def check(rc):
+            if rc != mqtt.MQTT_ERR_SUCCESS and not lost.done():
+                lost.set_exception(ConnectionError(mqtt.error_string(rc)))
+
+        def readable():
+            check(client.loop_read())
+            if client.want_write():  # replies queued by on_message
+                check(client.loop_write())
+
+        sock = client.socket()
+        self.loop.add_reader(sock, readable)
+        try:
+            while not lost.done():
+                check(client.loop_misc())
+                if client.want_write():
+                    check(client.loop_write())
+                await asyncio.wait([lost], timeout=0.5)
+            lost.result()
+        finally:
+            self.loop.remove_reader(sock)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='MQTT sound server')
+    parser.add_argument('--backend', choices=sorted(BACKENDS), default='nssound')
+    parser.add_argument('--sink', help='output file for the file backend, or the mixer instead of its player')
+    parser.add_argument('--player', default=PLAYER, help='command the mixer pipes raw 44.1kHz 16 bit stereo to')
+    parser.add_argument('--voices', type=int, default=8, help='mixer voices')
+    parser.add_argument('--broker', default='192.168.99.100')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    if args.backend == 'file' and not args.sink:
+        parser.error("the file backend needs --sink")
+
+    # Find out where the config files are and load our HASS api password
+    with open(os.path.join(basedir, 'secrets.yaml'), 'r') as fp:
+        config = yaml.safe_load(fp)
+        pw = config['http_password']
 
+    loop = asyncio.get_event_loop()
+    server = SoundServer(load_sounds(os.path.join(basedir, 'sounds')), BACKENDS[args.backend](args), loop)
 
+    # And start of the MQTT connection through the docker-machine
+    loop.run_until_complete(server.run(server.client(pw), args.broker, args.port))
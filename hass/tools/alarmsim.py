@@ -0,0 +1,224 @@
+#!/usr/bin/env python3
+"""
+ Run BWAlarm through scripted scenarios with no Home Assistant running.  A stand-in hass provides the
+ state machine and records switch service calls, timers run off a virtual clock so a 10 minute trigger
+ time costs nothing.  Checks each scenario ends where it should and reports events/sec along with the
+ time from sensor trip to the alarm switch, both virtual (policy) and wall clock (our hot path).
+ Needs the HASS virtualenv as bwalarm.py imports it.
+
+   ./alarmsim.py [rounds]
+"""
+import datetime
+import heapq
+import os
+import sys
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from homeassistant.core import State
+from homeassistant.const import STATE_ON, STATE_OFF
+import custom_components.alarm_control_panel.bwalarm as bwalarm
+
+EPOCH = datetime.datetime(2017, 1, 1, tzinfo=datetime.timezone.utc)
+
+
+class VirtualClock(object):
+    """ now() and one shot timers, time only moves when advance() is called """
+
+    def __init__(self):
+        self.now = EPOCH
+        self._timers = []
+        self._seq = 0
+
+    def track_point_in_utc_time(self, hass, action, when):
+        self._seq += 1
+        entry = [when, self._seq, action]
+        heapq.heappush(self._timers, entry)
+        def cancel():
+            entry[2] = None
+        return cancel
+
+    def advance(self, seconds):
+        end = self.now + datetime.timedelta(seconds=seconds)
+        while self._timers and self._timers[0][0] <= end:
+            when, seq, action = heapq.heappop(self._timers)
+            if action is not None:
+                self.now = when
+                action(when)
+        self.now = end
+
+
+class FakeStates(object):
+    def __init__(self):
+        self._states = dict()
+
+    def get(self, eid):
+        return self._states.get(eid)
+
+    def set(self, eid, state):
+        old = self._states.get(eid)
+        new = self._states[eid] = State(eid, state)
+        return old, new
+
+
+class FakeServices(object):
+    """ Records service calls with the virtual and wall clock time they were made """
+
+    def __init__(self, clock):
+        self._clock = clock
+        self.calls = []
+
+    def call(self, domain, service, data=None, blocking=False):
+        self.calls.append((self._clock.now, time.perf_counter(), domain, service, (data or {}).get('entity_id')))
+
+
+class FakeBus(object):
+    """ Counts the panel delta events and their size """
+
+    def __init__(self):
+        self.fired = 0
+        self.changes = 0
+
+    def fire(self, event_type, data=None):
+        self.fired += 1
+        self.changes += len((data or {}).get('changes', ()))
+
+
+class FakeConfig(object):
+    def path(self, *parts):
+        return os.path.join('/tmp', *parts)
+
+
+class FakeHass(object):
+    def __init__(self, clock):
+        self.states = FakeStates()
+        self.services = FakeServices(clock)
+        self.bus = FakeBus()
+        self.config = FakeConfig()
+
+
+class NullJournal(object):
+    def append(self, record): pass
+    def close(self):          pass
+
+
+class SimAlarm(bwalarm.BWAlarm):
+    """ The real alarm with the bits that need a running HASS swapped out """
+
+    def __init__(self, hass, config):
+        super().__init__(hass, config)
+        self.entity_id = 'alarm_control_panel.sim'  # as HASS would when adding it
+        self._journal = NullJournal()
+        self.events = 0
+        self.writes = 0
+
+    def tripped(self):
+        return self.readtripped()
+
+    def process_event(self, event):
+        self.events += 1
+        super().process_event(event)
+
+    def schedule_update_ha_state(self, force_refresh=False):
+        self.writes += 1
+
+
+class Scenario(object):
+    def __init__(self, config):
+        # each scenario gets its own clock so nothing left running leaks into the next
+        self.clock = clock = VirtualClock()
+        bwalarm.now = lambda: clock.now
+        bwalarm.track_point_in_utc_time = clock.track_point_in_utc_time
+        self.hass = FakeHass(clock)
+        self.alarm = SimAlarm(self.hass, config)
+        self.config = config
+        self.trips = []  # (virtual, wall) time of each trip
+        for eid in self.alarm._allsensors:
+            self.hass.states.set(eid, STATE_OFF)
+
+    def trip(self, eid, state=STATE_ON):
+        self.trips.append((self.clock.now, time.perf_counter()))
+        old, new = self.hass.states.set(eid, state)
+        self.alarm.state_change_listener(eid, old, new)
+
+    def alarm_latency(self):
+        """ (virtual, wall) seconds from the first trip to the alarm switch turning on, or None """
+        if not self.trips:
+            return None
+        for vt, wt, domain, service, eid in self.hass.services.calls:
+            if service == 'turn_on' and eid == self.alarm._alarm and wt >= self.trips[0][1]:
+                return (vt - self.trips[0][0]).total_seconds(), wt - self.trips[0][1]
+        return None
+
+
+def arm_away(s):
+    s.alarm.alarm_arm_away()
+    s.clock.advance(s.config['pending_time'] + 1)
+    return s.alarm.state == bwalarm.STATE_ALARM_ARMED_AWAY
+
+def delayed_trip(s):
+    arm_away(s)
+    s.trip(sorted(s.alarm._delayed)[0])
+    if s.alarm.state != bwalarm.STATE_ALARM_WARNING:
+        return False
+    s.clock.advance(s.config['pending_time'] + 1)
+    return s.alarm.state == bwalarm.STATE_ALARM_TRIGGERED
+
+def disarm_in_window(s):
+    arm_away(s)
+    s.trip(sorted(s.alarm._delayed)[0])
+    s.clock.advance(s.config['pending_time'] / 2)
+    s.alarm.alarm_disarm()
+    s.clock.advance(s.config['pending_time'] * 2)
+    return s.alarm.state == bwalarm.STATE_ALARM_DISARMED and s.alarm_latency() is None
+
+def immediate_trip(s):
+    arm_away(s)
+    s.trip(sorted(s.alarm._immediate)[0])
+    return s.alarm.state == bwalarm.STATE_ALARM_TRIGGERED
+
+def timeout_return(s):
+    immediate_trip(s)
+    s.clock.advance(s.config['trigger_time'] + 1)
+    return s.alarm.state == bwalarm.STATE_ALARM_ARMED_AWAY
+
+SCENARIOS = [arm_away, delayed_trip, disarm_in_window, immediate_trip, timeout_return]
+
+
+def run(config, rounds):
+    failures = 0
+    events = 0
+    deltas = changes = 0
+    latencies = {}
+    start = time.perf_counter()
+    for ii in range(rounds):
+        for scenario in SCENARIOS:
+            s = Scenario(config)
+            if not scenario(s):
+                failures += 1
+                print("FAILED {} ended in {}".format(scenario.__name__, s.alarm.state))
+            events += s.alarm.events
+            deltas += s.hass.bus.fired
+            changes += s.hass.bus.changes
+            latency = s.alarm_latency()
+            if latency is not None:
+                latencies.setdefault(scenario.__name__, []).append(latency)
+    elapsed = time.perf_counter() - start
+
+    count = rounds * len(SCENARIOS)
+    print("{} scenarios, {} failed, {:.0f} scenarios/sec, {:.0f} events/sec".format(
+            count, failures, count/elapsed, events/elapsed))
+    print("  panel deltas {:.1f} per scenario, {:.1f} sensor changes each".format(deltas/count, changes/max(deltas, 1)))
+    for name, values in sorted(latencies.items()):
+        wall = sorted(v[1] for v in values)
+        print("  {:16s} trip->alarm virtual {:6.1f}s  wall p50 {:6.1f}us  max {:6.1f}us".format(
+                name, values[0][0], wall[len(wall)//2]*1e6, wall[-1]*1e6))
+    return failures
+
+
+if __name__ == '__main__':
+    rounds = int(sys.argv[1]) if len(sys.argv) > 1 else 2000
+    with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'alarm.yaml')) as fp:
+        config = bwalarm.PLATFORM_SCHEMA(yaml.safe_load(fp))
+    sys.exit(run(config, rounds) and 1 or 0)
@@ -0,0 +1,112 @@
+#!/usr/bin/env python3
+"""
+ Fuzz the bwalarm state machine against the old if/elif process_event and time both.
+ Every random event is checked for the same next state, returnto and entry/exit actions,
+ and we report which (state, returnto, event) combinations were exercised.
+
+   ./bench_alarmfsm.py [events]
+"""
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from custom_components.bwalarmfsm import *
+from custom_components.bwalarmfsm import TABLE
+
+
+def reference(state, returnto, event):
+    """ The original process_event logic, returns (state, returnto, entry actions, exit actions) """
+    old = state
+    if event == Events.Disarm:
+        state = STATE_ALARM_DISARMED
+    elif event == Events.Trigger:
+        state = STATE_ALARM_TRIGGERED
+    elif old == STATE_ALARM_DISARMED:
+        if   event == Events.ArmHome:       state = STATE_ALARM_ARMED_HOME
+        elif event == Events.ArmAway:       state = STATE_ALARM_PENDING
+    elif old == STATE_ALARM_PENDING:
+        if   event == Events.Timeout:       state = STATE_ALARM_ARMED_AWAY
+    elif old == STATE_ALARM_ARMED_HOME or \
+         old == STATE_ALARM_ARMED_AWAY:
+        if   event == Events.ImmediateTrip: state = STATE_ALARM_TRIGGERED
+        elif event == Events.DelayedTrip:   state = STATE_ALARM_WARNING
+    elif old == STATE_ALARM_WARNING:
+        if   event == Events.Timeout:       state = STATE_ALARM_TRIGGERED
+    elif old == STATE_ALARM_TRIGGERED:
+        if   event == Events.Timeout:       state = returnto
+
+    new = state
+    entry = exit = ()
+    if old != new:
+        if new == STATE_ALARM_WARNING:
+            entry = (Actions.WarningOn, Actions.PendingTimer)
+        elif new == STATE_ALARM_TRIGGERED:
+            entry = (Actions.AlarmOn, Actions.TriggerTimer)
+        elif new == STATE_ALARM_PENDING:
+            entry = (Actions.WarningOn, Actions.PendingTimer, Actions.SignalsAway)
+            returnto = STATE_ALARM_ARMED_AWAY
+        elif new == STATE_ALARM_ARMED_HOME:
+            entry = (Actions.SignalsHome,)
+            returnto = new
+        elif new == STATE_ALARM_DISARMED:
+            entry = (Actions.SignalsClear,)
+            returnto = new
+        if old == STATE_ALARM_WARNING or old == STATE_ALARM_PENDING:
+            exit = (Actions.WarningOff,)
+        elif old == STATE_ALARM_TRIGGERED:
+            exit = (Actions.AlarmOff,)
+    return state, returnto, entry, exit
+
+
+def fuzz(events):
+    machine = AlarmMachine()
+    state = returnto = STATE_ALARM_DISARMED
+    seen = set()
+    for event in events:
+        seen.add((state, returnto, event))
+        t = machine.process(event)
+        expect = reference(state, returnto, event)
+        got = (machine.state, machine.returnto, t.entry, t.exit)
+        if got != expect:
+            print("MISMATCH {} {} {}: table {} reference {}".format(state, returnto, event, got, expect))
+            return False
+        state, returnto = expect[:2]
+    reachable = set()
+    todo = [(STATE_ALARM_DISARMED, STATE_ALARM_DISARMED)]
+    while todo:
+        mode = todo.pop()
+        for event, t in TABLE[mode].items():
+            if (mode + (event,)) not in reachable:
+                reachable.add(mode + (event,))
+                todo.append(t.mode)
+    print("fuzzed {} events, no mismatches, covered {} of {} reachable (state, returnto, event)".format(
+            len(events), len(seen & reachable), len(reachable)))
+    return seen >= reachable
+
+def bench(name, func, events):
+    start = time.perf_counter()
+    func(events)
+    elapsed = time.perf_counter() - start
+    print("{:10s} {:12.0f} events/sec".format(name, len(events)/elapsed))
+
+def run_table(events):
+    process = AlarmMachine().process
+    for event in events:
+        process(event)
+
+def run_reference(events):
+    state = returnto = STATE_ALARM_DISARMED
+    for event in events:
+        state, returnto, entry, exit = reference(state, returnto, event)
+
+
+if __name__ == '__main__':
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 2000000
+    rand = random.Random(0)
+    events = [rand.choice(list(Events)) for ii in range(count)]
+    ok = fuzz(events)
+    bench("reference", run_reference, events)
+    bench("table", run_table, events)
+    sys.exit(0 if ok else 1)
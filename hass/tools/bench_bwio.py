@@ -0,0 +1,132 @@
+#!/usr/bin/env python3
+"""
+ End to end timing of the bwio.py hot path against the pty simulator:
+   input edge written by the board -> entity update scheduled
+   turn_on/off -> O= report confirming the relay -> entity update scheduled
+ at 1, 100 and 1000 transitions/sec.  Needs the HASS virtualenv as bwio.py imports it.
+
+   ./bench_bwio.py [--transport thread|asyncio] [--duration 5]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from custom_components.bwio import BWIOBoard, BWIOThreadedTransport, BWIOAsyncTransport
+from bwiosim import BWIOSimulator
+
+
+class ProbeHass(object):
+    """ Just the piece of HASS the asyncio transport uses to queue an update """
+
+    def __init__(self, loop):
+        self.loop = loop
+
+    def async_add_job(self, target):
+        self.loop.create_task(target)
+
+
+class Probe(object):
+    """
+        Stands in for the entity, notes how long since the edge we are waiting on.  Only has the update
+        methods a 0.49 Entity has, so a transport calling anything else fails here too.
+    """
+
+    def __init__(self, pin, stamps, latencies, loop):
+        self.hass = ProbeHass(loop)
+        self._pin = pin
+        self._state = None
+        self._filter = None
+        self._stamps = stamps
+        self._latencies = latencies
+
+    def note(self):
+        stamp = self._stamps.pop(self._pin, None)
+        if stamp is not None:
+            self._latencies.append(time.perf_counter() - stamp)
+
+    def schedule_update_ha_state(self, force_refresh=False):
+        self.note()
+
+    @asyncio.coroutine
+    def async_update_ha_state(self, force_refresh=False):
+        self.note()
+
+
+def percentile(values, pct):
+    if not values:
+        return float('nan')
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * pct / 100))]
+
+def summary(name, rate, sent, latencies):
+    print("{:7s} {:5d}/s  sent {:6d}  seen {:6d}  p50 {:7.3f}ms  p99 {:7.3f}ms  max {:7.3f}ms".format(
+            name, rate, sent, len(latencies), percentile(latencies, 50)*1000,
+            percentile(latencies, 99)*1000, max(latencies or [float('nan')])*1000))
+
+def connect(sim, kind, window):
+    loop = None
+    if kind == 'asyncio':
+        loop = asyncio.new_event_loop()
+        threading.Thread(target=loop.run_forever, daemon=True).start()
+        transport = BWIOAsyncTransport(sim.port, loop)
+    else:
+        transport = BWIOThreadedTransport(sim.port)
+    return BWIOBoard(transport, window), loop
+
+def bench_inputs(kind, rate, duration, window):
+    sim = BWIOSimulator().start()
+    board, loop = connect(sim, kind, window)
+    latencies = []
+    for pin in range(16):
+        board.register(board._inputs, board._lastinput, Probe(pin, sim.stamps, latencies, loop))
+    board.ping_input()
+    time.sleep(0.2)
+    sim.stamps.clear()
+    sent = sim.random(rate, duration)
+    time.sleep(0.5)
+    summary("input", rate, sent, latencies)
+    board.close()
+    sim.stop()
+
+def bench_outputs(kind, rate, duration, window):
+    sim = BWIOSimulator().start()
+    board, loop = connect(sim, kind, window)
+    latencies = []
+    stamps = dict()
+    for pin in range(16):
+        board.register(board._outputs, board._lastoutput, Probe(pin, stamps, latencies, loop))
+    board.ping_output()
+    time.sleep(0.2)
+    interval = 1.0 / rate
+    start = time.perf_counter()
+    sent = 0
+    while time.perf_counter() - start < duration:
+        pin = sent % 16
+        stamps[pin] = time.perf_counter()
+        board.set_output(pin, not (sim.outputs & (1 << pin)))
+        sent += 1
+        wait = start + sent*interval - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+    time.sleep(0.5)
+    summary("relay", rate, sent, latencies)
+    print("        write queue: queued {} coalesced {}".format(board.writes.queued, board.writes.coalesced))
+    board.close()
+    sim.stop()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BWIO end to end latency')
+    parser.add_argument('--transport', choices=['thread', 'asyncio'], default='thread')
+    parser.add_argument('--duration', type=float, default=5)
+    parser.add_argument('--window', type=float, default=20, help='write coalescing window in ms')
+    args = parser.parse_args()
+
+    print("transport {}, write window {}ms".format(args.transport, args.window))
+    for rate in (1, 100, 1000):
+        bench_inputs(args.transport, rate, args.duration, args.window/1000.0)
+        bench_outputs(args.transport, rate, args.duration, args.window/1000.0)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+"""
+ Replay a BWIO line stream through the old regex parsing and the new decoder, report lines/sec.
+ Pass a file of recorded lines (one frame per line) or let it make up a stream.
+"""
+import os
+import random
+import re
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from custom_components.bwioproto import BWIODecoder
+
+
+def synthetic(count):
+    """ Mostly input reports with the odd output/sampling report and a little line noise """
+    lines = []
+    mask = 0x4F2B
+    for ii in range(count):
+        r = random.random()
+        if r < 0.90:
+            mask ^= 1 << random.randrange(16)
+            lines.append("I=%04X" % mask)
+        elif r < 0.98:
+            lines.append("O=%04X" % random.randrange(0x10000))
+        elif r < 0.99:
+            lines.append("S=%X" % random.randrange(1, 200))
+        else:
+            lines.append("I=ZZ")
+    return lines
+
+def legacy(lines):
+    """ What handle_line used to do for every line """
+    for line in lines:
+        ins = re.match(r"I=([0-9,A-F]+)", line)
+        if ins is not None:
+            int(ins.group(1), 16)
+        outs = re.match(r"O=([0-9,A-F]+)", line)
+        if outs is not None:
+            int(outs.group(1), 16)
+
+def decoder(lines):
+    d = BWIODecoder()
+    for line in lines:
+        d.decode(line)
+    return d
+
+def bench(name, func, lines):
+    start = time.perf_counter()
+    ret = func(lines)
+    elapsed = time.perf_counter() - start
+    print("{:10s} {:10.0f} lines/sec".format(name, len(lines)/elapsed))
+    return ret
+
+if __name__ == '__main__':
+    if len(sys.argv) > 1:
+        with open(sys.argv[1]) as fp:
+            lines = [l.rstrip('\r\n') for l in fp if l.strip()]
+    else:
+        lines = synthetic(200000)
+
+    try:
+        bench("regex", legacy, lines)
+    except ValueError:
+        print("regex      chokes on this stream")
+    d = bench("decoder", decoder, lines)
+    print("decoded {} malformed {}".format(d.decoded, d.malformed))
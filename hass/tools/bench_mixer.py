@@ -0,0 +1,51 @@
+#!/usr/bin/env python3
+"""
+ CPU cost of the soundserver.py software mixer per second of audio with 1 to 16 voices playing, so we know
+ what it needs from a small always on box.  Mixes flat out rather than in real time.  Needs numpy.
+
+   ./bench_mixer.py [--seconds 30]
+"""
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import soundserver
+from bench_soundserver import make_sounds
+
+
+def bench(sounds, voices, seconds):
+    # looping copies of the warning so every voice stays busy, plus a doorbell on top
+    playing = [sounds['doorbell']]
+    for ii in range(voices-1):
+        copy = soundserver.Sound.__new__(soundserver.Sound)
+        copy.__dict__.update(sounds['warning'].__dict__, name='warning{}'.format(ii))
+        playing.append(copy)
+    mixer = soundserver.MixerBackend(os.devnull, voices)  # never prepared, nothing is written
+    mixer.load({sound.name: sound for sound in playing})
+    for sound in playing:
+        mixer.play(sound)
+
+    frames = int(mixer.RATE * mixer.PERIOD)
+    periods = int(seconds / mixer.PERIOD)
+    start = time.process_time()
+    for ii in range(periods):
+        mixer.mix(frames)
+        if ii % 100 == 0:  # keep the doorbell going, it doesn't loop
+            mixer.play(playing[0])
+    cpu = time.process_time() - start
+    busy = sum(v is not None for v in mixer.voices)
+    print("{:2d} voices ({:2d} busy)  {:6.2f}ms cpu per second of audio  {:5.2f}% of a core".format(
+            voices, busy, cpu / seconds * 1000, cpu / seconds * 100))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='soundserver mixer cpu')
+    parser.add_argument('--seconds', type=float, default=30, help='seconds of audio to mix for each count')
+    args = parser.parse_args()
+
+    sounds = soundserver.load_sounds(make_sounds(tempfile.mkdtemp()))
+    for voices in (1, 2, 4, 8, 16):
+        bench(sounds, voices, args.seconds)
@@ -0,0 +1,160 @@
+#!/usr/bin/env python3
+"""
+ Replay a day of our chatty entities against a sqlite stand-in for the recorder database, once the way the
+ stock recorder writes them (event + state row with full attributes, a commit per change) and once through
+ bwrecorder (attribute-light event and state rows, a transaction per batch).  Reports rows, bytes and insert time.
+ The alarm and locks attributes are the old full versions for the stock run.  Needs the HASS virtualenv.
+
+   ./bench_recorder.py [--scale 1.0] [--batch 100]
+"""
+import argparse
+import datetime
+import os
+import random
+import sys
+import tempfile
+import time
+import yaml
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+from sqlalchemy import create_engine
+from sqlalchemy.orm import sessionmaker
+from homeassistant.core import Event, State
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.components.recorder.models import Base, Events, States
+import custom_components.bwrecorder as bwrecorder
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+# changes per day, rough numbers from watching the logbook
+VOLUME = {
+    'binary_sensor.primary_motion':     1200,
+    'binary_sensor.doorbell':             10,
+    'binary_sensor.front_door':           40,
+    'binary_sensor.back_door':            40,
+    'binary_sensor.garage_door':          20,
+    'binary_sensor.patio_slider':         20,
+    'binary_sensor.bedroom_slider':       10,
+    'binary_sensor.little_window':         4,
+    'binary_sensor.dining_room_window':    4,
+    'binary_sensor.living_room_window':    4,
+    'binary_sensor.office_window':         4,
+    'sensor.front_door_alarm_type':       20,
+    'sensor.front_door_alarm_level':      20,
+    'sensor.back_door_alarm_type':        20,
+    'sensor.back_door_alarm_level':       20,
+    'alarm_control_panel.house':          40,
+    'locksinterface.singleton':         2880,
+}
+
+
+def alarmattributes():
+    with open(os.path.join(HERE, '..', 'alarm.yaml')) as fp:
+        conf = yaml.safe_load(fp)
+    everything = sorted(set(conf['immediate'] + conf['delayed'] + conf['notathome'] + conf['headsup']))
+    old = { 'immediate': sorted(conf['immediate']), 'delayed': sorted(conf['delayed']), 'ignored': [],
+            'allsensors': everything, 'changedby': 'binary_sensor.front_door', 'friendly_name': 'House' }
+    new = { 'changedby': 'binary_sensor.front_door', 'friendly_name': 'House' }
+    return old, new
+
+def locksattributes():
+    values = { nodeid: { slot: (slot < 6 and 'person{}'.format(slot) or '_unassigned') for slot in range(1, 31) }
+               for nodeid in (4, 5) }
+    common = { 'rtt': 850, 'provisioning': [], 'friendly_name': 'singleton', 'hidden': True }
+    old = dict(common, values=values, modtime=1500000000,
+               statusreader={'hits': 1200, 'misses': 60, 'reads': 60, 'bytes': 2880})
+    new = common
+    return old, new
+
+def zwaveattributes(eid):
+    return { 'friendly_name': eid.split('.')[1].replace('_', ' ').title(), 'node_id': 4, 'value_index': 0,
+             'value_instance': 1, 'value_id': '72057594110050305', 'battery_level': 90, 'hidden': True }
+
+def day(scale):
+    """ (when, entity_id, state, old attributes, new attributes) for each change, in order """
+    start = datetime.datetime(2017, 7, 1, tzinfo=datetime.timezone.utc)
+    rand = random.Random(1)
+    alarm, locks = alarmattributes(), locksattributes()
+    changes = []
+    for eid, count in VOLUME.items():
+        if eid.startswith('binary_sensor'):
+            attrs = { 'friendly_name': eid.split('.')[1].replace('_', ' ').title(), 'device_class': 'opening' }
+            attrs = (attrs, attrs)
+            states = ('on', 'off')
+        elif eid.startswith('sensor'):
+            attrs = (zwaveattributes(eid),) * 2
+            states = ('0', '21', '22', '255')
+        elif eid.startswith('alarm'):
+            attrs = alarm
+            states = ('disarmed', 'armed_home', 'armed_away', 'pending', 'warning')
+        else:
+            attrs = locks
+            states = ('0 of 60', '1 of 60', '2 of 60')
+        for ii in range(int(count * scale)):
+            when = start + datetime.timedelta(seconds=rand.uniform(0, 86400))
+            changes.append((when, eid, states[ii % len(states)], attrs[0], attrs[1]))
+    changes.sort(key=lambda c: c[0])
+    return changes
+
+
+def database():
+    path = tempfile.mktemp(suffix='.db')
+    engine = create_engine('sqlite:///' + path)
+    Base.metadata.create_all(engine)
+    return path, engine
+
+def stock(changes):
+    """ As the recorder does it, event then state, a transaction each """
+    path, engine = database()
+    session = sessionmaker(bind=engine)()
+    last = dict()
+    rows = size = 0
+    start = time.perf_counter()
+    for when, eid, state, oldattrs, newattrs in changes:
+        new = State(eid, state, oldattrs, when, when)
+        event = Event(EVENT_STATE_CHANGED, {'entity_id': eid, 'old_state': last.get(eid), 'new_state': new}, time_fired=when)
+        last[eid] = new
+        dbevent = Events.from_event(event)
+        session.add(dbevent)
+        session.flush()
+        dbstate = States.from_event(event)
+        dbstate.event_id = dbevent.event_id
+        session.add(dbstate)
+        session.commit()
+        rows += 2
+        size += len(dbevent.event_data) + len(dbstate.attributes)
+    elapsed = time.perf_counter() - start
+    session.close()
+    return rows, size, os.path.getsize(path), elapsed
+
+def batched(changes, batch):
+    """ Through bwrecorder's writer, batch rows at a time """
+    path, engine = database()
+    writer = bwrecorder.BatchWriter('sqlite:///' + path, batch, 10)
+    conn = writer.connect()
+    size = 0
+    pending = []
+    for when, eid, state, oldattrs, newattrs in changes:
+        row = bwrecorder.staterow(State(eid, state, newattrs, when, when))
+        size += len(row['attributes']) + len(row['event_data'])
+        pending.append(row)
+        if len(pending) >= batch:
+            writer.write(conn, pending)
+            pending = []
+    if pending:
+        writer.write(conn, pending)
+    conn.close()
+    return writer.rows, size, os.path.getsize(path), writer.elapsed
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='recorder write volume for a day')
+    parser.add_argument('--scale', type=float, default=1.0, help='multiply the daily volume')
+    parser.add_argument('--batch', type=int, default=100)
+    args = parser.parse_args()
+
+    changes = day(args.scale)
+    print("{} state changes".format(len(changes)))
+    for name, result in (('stock', stock(changes)), ('bwrecorder', batched(changes, args.batch))):
+        rows, size, dbsize, elapsed = result
+        print("{:10s} rows {:6d}  json {:9d} bytes  db {:9d} bytes  insert {:7.2f}s".format(name, rows, size, dbsize, elapsed))
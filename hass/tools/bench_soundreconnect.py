@@ -0,0 +1,97 @@
+#!/usr/bin/env python3
+"""
+ Run soundserver.py against the stand-in broker, send it a steady stream of switch commands (QoS 1, as the
+ mqtt switches in configuration.yaml publish them) and drop its connection every few seconds.  Reports how
+ long each reconnect took, how many commands never made it to the backend and whether the retained
+ switches/pub state ended up matching the last command.  Needs paho-mqtt.
+
+   ./bench_soundreconnect.py [--rate 50] [--duration 20] [--every 2] [--qos 1]
+"""
+import argparse
+import asyncio
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import soundserver
+from mqttbroker import MQTTBroker
+from bench_soundserver import make_sounds, percentile
+
+
+class CountingBackend(soundserver.NullBackend):
+    def __init__(self):
+        super().__init__()
+        self.handled = 0
+
+    def play(self, sound):
+        self.handled += 1
+        super().play(sound)
+
+    def stop(self, sound):
+        self.handled += 1
+        super().stop(sound)
+
+
+def wait_for(test, timeout):
+    end = time.perf_counter() + timeout
+    while not test() and time.perf_counter() < end:
+        time.sleep(0.01)
+    return test()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='soundserver reconnect test')
+    parser.add_argument('--rate', type=float, default=50, help='commands per second')
+    parser.add_argument('--duration', type=float, default=20)
+    parser.add_argument('--every', type=float, default=2, help='seconds between forced disconnects')
+    parser.add_argument('--qos', type=int, choices=[0, 1], default=1, help='as the mqtt switches publish, 0 loses commands')
+    args = parser.parse_args()
+
+    broker = MQTTBroker().start()
+    backend = CountingBackend()
+    loop = asyncio.new_event_loop()
+    server = soundserver.SoundServer(soundserver.load_sounds(make_sounds(tempfile.mkdtemp())), backend, loop)
+    threading.Thread(target=loop.run_forever, daemon=True).start()
+    asyncio.run_coroutine_threadsafe(server.run(server.client('test'), '127.0.0.1', broker.port), loop)
+    if not wait_for(lambda: broker.connected('sound-client') and server.connected, 5):
+        sys.exit("sound server never connected")
+    time.sleep(0.2)
+
+    sent = 0
+    payload = b'OFF'
+    interval = 1.0 / args.rate
+    start = nextkick = time.perf_counter()
+    while time.perf_counter() - start < args.duration:
+        now = time.perf_counter()
+        if now >= nextkick + args.every:
+            broker.kick('sound-client')
+            nextkick = now
+        payload = payload == b'ON' and b'OFF' or b'ON'
+        broker.publish('switches/set/doorbell', payload, qos=args.qos)
+        sent += 1
+        wait = start + sent*interval - time.perf_counter()
+        if wait > 0:
+            time.sleep(wait)
+
+    wait_for(lambda: backend.handled >= sent, 10)
+    time.sleep(0.5)
+
+    reconnects = []
+    for clientid, kicked in broker.kicks:
+        after = [t for c, t, present in broker.connects if c == clientid and t > kicked]
+        if after:
+            reconnects.append(min(after) - kicked)
+    present = all(p for c, t, p in broker.connects[1:] if c == 'sound-client')
+    retained = broker.retained.get('switches/pub/doorbell')
+
+    print("{} commands over {:.0f}s, {} disconnects".format(sent, args.duration, len(broker.kicks)))
+    if reconnects:
+        print("reconnect  p50 {:.1f}ms  max {:.1f}ms  ({} of {} came back, session kept: {})".format(
+                percentile(reconnects, 50)*1000, max(reconnects)*1000, len(reconnects), len(broker.kicks), present))
+    print("handled {}  lost {}  duplicated {}".format(backend.handled, max(0, sent - backend.handled),
+            max(0, backend.handled - sent)))
+    print("retained state {} last command {} {}".format(retained, payload, retained == payload and "ok" or "STALE"))
+    broker.stop()
@@ -0,0 +1,86 @@
+#!/usr/bin/env python3
+"""
+ Time from a switches/set/<sound> message arriving in soundserver.py to the backend handing over the first
+ audio frame, for the null and file backends.  Uses the wavs in ../sounds if there are any, otherwise makes
+ a short doorbell and looping warning.  Also shows what decoding from disk on each play would have cost.
+
+   ./bench_soundserver.py [--count 1000]
+"""
+import argparse
+import asyncio
+import collections
+import math
+import os
+import struct
+import sys
+import tempfile
+import time
+import wave
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import soundserver
+
+Message = collections.namedtuple('Message', 'topic payload')
+
+
+class Client(object):
+    def publish(self, topic, payload, *args, **kwargs): pass
+
+
+def make_sounds(directory):
+    for name, seconds, freq in (('doorbell', 1.5, 880), ('warning', 2.0, 440)):
+        with wave.open(os.path.join(directory, name+'.wav'), 'wb') as w:
+            w.setnchannels(2)
+            w.setsampwidth(2)
+            w.setframerate(44100)
+            frames = bytearray()
+            for ii in range(int(44100*seconds)):
+                v = int(8000 * math.sin(2*math.pi*freq*ii/44100))
+                frames += struct.pack('<hh', v, v)
+            w.writeframes(bytes(frames))
+    return directory
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(len(values)-1, int(len(values) * pct / 100))]
+
+def bench(name, backend, sounds, count):
+    received = dict()
+    latencies = []
+    def first_frame(sound):
+        latencies.append(time.perf_counter() - received.pop(sound))
+    backend.first_frame = first_frame
+
+    server = soundserver.SoundServer(sounds, backend, asyncio.new_event_loop())
+    client = Client()
+    names = sorted(sounds)
+    for ii in range(count):
+        sound = names[ii % len(names)]
+        received[sound] = time.perf_counter()
+        server.on_message(client, None, Message('switches/set/'+sound, b'ON'))
+        while sound in received:   # file backend hands over from its own thread
+            time.sleep(0.0001)
+        server.on_message(client, None, Message('switches/set/'+sound, b'OFF'))
+    backend.close()
+    print("{:5s} {:6d} plays  p50 {:8.1f}us  p99 {:8.1f}us  max {:8.1f}us".format(name, len(latencies),
+            percentile(latencies, 50)*1e6, percentile(latencies, 99)*1e6, max(latencies)*1e6))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='soundserver receipt to first frame')
+    parser.add_argument('--count', type=int, default=1000)
+    args = parser.parse_args()
+
+    tmp = tempfile.mkdtemp()
+    directory = os.path.join(soundserver.basedir, 'sounds')
+    if not os.path.isdir(directory):
+        directory = make_sounds(tmp)
+
+    start = time.perf_counter()
+    sounds = soundserver.load_sounds(directory)
+    decode = (time.perf_counter() - start) / len(sounds)
+    print("{} sounds, {:.1f}ms each to read and decode, {:.1f}s of audio cached".format(
+            len(sounds), decode*1000, sum(s.duration for s in sounds.values())))
+
+    bench('null', soundserver.NullBackend(), sounds, args.count)
+    bench('file', soundserver.FileBackend(os.path.join(tmp, 'out.raw')), sounds, args.count)
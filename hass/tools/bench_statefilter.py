@@ -0,0 +1,61 @@
+#!/usr/bin/env python3
+"""
+ How many times do the alarm and ghost listeners get called per 10k state changes on the bus, listening
+ to every EVENT_STATE_CHANGED (the old way) vs async_track_state_change on just their entities.
+ Needs the HASS virtualenv.
+"""
+import asyncio
+import random
+import time
+
+from homeassistant.core import HomeAssistant, callback
+from homeassistant.const import EVENT_STATE_CHANGED
+from homeassistant.helpers.event import async_track_state_change
+
+ALARM_INPUTS = ['binary_sensor.bedroom_slider', 'binary_sensor.front_door', 'binary_sensor.back_door',
+                'binary_sensor.primary_motion', 'binary_sensor.dining_room_window', 'binary_sensor.little_window',
+                'binary_sensor.living_room_window', 'binary_sensor.office_window', 'binary_sensor.patio_slider']
+GHOST = ['sun.sun', 'alarm_control_panel.house']
+OTHERS = ['sensor.thermostat_temperature', 'climate.thermostat_heating_1', 'sensor.front_door_alarm_type',
+          'sensor.back_door_alarm_level', 'switch.driveway_light_switch', 'switch.garage_door',
+          'lock.front_door_locked', 'binary_sensor.doorbell', 'binary_sensor.pin2'] + \
+         ['sensor.zwave_poll_{}'.format(ii) for ii in range(20)]
+EVENTS = 10000
+
+
+def run(loop, filtered):
+    hass = HomeAssistant(loop)
+    counts = {'alarm': 0, 'ghost': 0}
+
+    @callback
+    def alarm_event(event):        counts['alarm'] += 1
+    @callback
+    def ghost_event(event):        counts['ghost'] += 1
+    @callback
+    def alarm_change(eid, old, new): counts['alarm'] += 1
+    @callback
+    def ghost_change(eid, old, new): counts['ghost'] += 1
+
+    if filtered:
+        async_track_state_change(hass, ALARM_INPUTS, alarm_change)
+        async_track_state_change(hass, GHOST, ghost_change)
+    else:
+        hass.bus.async_listen(EVENT_STATE_CHANGED, alarm_event)
+        hass.bus.async_listen(EVENT_STATE_CHANGED, ghost_event)
+
+    # weighted toward the chatty stuff like zwave polling and thermostats
+    entities = ALARM_INPUTS + GHOST + OTHERS * 5
+    rand = random.Random(1)
+    start = time.perf_counter()
+    for ii in range(EVENTS):
+        hass.states.async_set(rand.choice(entities), str(ii))
+    loop.run_until_complete(hass.async_block_till_done())
+    elapsed = time.perf_counter() - start
+    print("{:8s} alarm {:6d}  ghost {:6d}  per {} events, {:.3f}s".format(
+            filtered and "filtered" or "all", counts['alarm'], counts['ghost'], EVENTS, elapsed))
+
+
+if __name__ == '__main__':
+    loop = asyncio.new_event_loop()
+    run(loop, False)
+    run(loop, True)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+"""
+ Pretend to be the BWIO board on a pseudo-terminal so bwio.py can be run without the hardware.
+ Answers I/O/S queries and O<pin>=<val>/S=<ms> writes and can generate input transitions.
+
+   ./bwiosim.py --rate 2        # prints the pty path, point bwio: port: at it
+"""
+import argparse
+import os
+import random
+import threading
+import time
+import tty
+
+
+class BWIOSimulator(object):
+    """ The board side of a pty, speaks the same line protocol as the firmware """
+
+    TERMINATOR = b'\r\n'
+
+    def __init__(self, inputs=0, outputs=0, debounce=50):
+        self.inputs = inputs
+        self.outputs = outputs
+        self.debounce = debounce
+        self.stamps = dict()      # input pin -> perf_counter when we last reported it changing
+        self.received = 0         # command lines from the host
+        self._master, self._slave = os.openpty()
+        tty.setraw(self._slave)   # no echo/line editing before pyserial gets to it
+        self.port = os.ttyname(self._slave)
+        self._lock = threading.Lock()
+        self._thread = threading.Thread(target=self._reader, daemon=True)
+        self._running = False
+
+    def start(self):
+        self._running = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._running = False
+        os.close(self._master)
+        os.close(self._slave)
+
+    def report(self, kind):
+        if kind == 'I':
+            self._write("I=%04X" % self.inputs)
+        elif kind == 'O':
+            self._write("O=%04X" % self.outputs)
+        elif kind == 'S':
+            self._write("S=%X" % self.debounce)
+
+    def set_input(self, pin, val):
+        """ Change one input and report the new mask, returns the time it went out """
+        with self._lock:
+            if val:
+                self.inputs |= (1 << pin)
+            else:
+                self.inputs &= ~(1 << pin)
+            stamp = self.stamps[pin] = time.perf_counter()
+            self._writelocked("I=%04X" % self.inputs)
+        return stamp
+
+    def script(self, steps):
+        """ steps is a list of (delay seconds, pin, value) """
+        for delay, pin, val in steps:
+            time.sleep(delay)
+            self.set_input(pin, val)
+
+    def random(self, rate, duration, pins=range(16)):
+        """ Toggle random pins at rate transitions/sec for duration seconds, returns number of transitions """
+        pins = list(pins)
+        interval = 1.0 / rate
+        start = time.perf_counter()
+        count = 0
+        while time.perf_counter() - start < duration:
+            pin = random.choice(pins)
+            self.set_input(pin, not (self.inputs & (1 << pin)))
+            count += 1
+            wait = start + count*interval - time.perf_counter()
+            if wait > 0:
+                time.sleep(wait)
+        return count
+
+    def _write(self, line):
+        with self._lock:
+            self._writelocked(line)
+
+    def _writelocked(self, line):
+        os.write(self._master, line.encode('ascii') + self.TERMINATOR)
+
+    def _reader(self):
+        buf = b''
+        while self._running:
+            try:
+                data = os.read(self._master, 1024)
+            except OSError:
+                return
+            if not data:
+                return
+            buf += data
+            while self.TERMINATOR in buf:
+                line, buf = buf.split(self.TERMINATOR, 1)
+                self._command(line.decode('ascii', 'replace').strip())
+
+    def _command(self, line):
+        self.received += 1
+        if line in ('I', 'O', 'S'):
+            self.report(line)
+        elif line.startswith('S='):
+            self.debounce = int(line[2:], 16)
+            self.report('S')
+        elif line.startswith('O') and '=' in line:
+            pin, val = line[1:].split('=', 1)
+            pin = int(pin, 16)
+            with self._lock:
+                if int(val, 16):
+                    self.outputs |= (1 << pin)
+                else:
+                    self.outputs &= ~(1 << pin)
+                self._writelocked("O=%04X" % self.outputs)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='BWIO board emulator on a pty')
+    parser.add_argument('--rate', type=float, default=0, help='random input transitions per second, 0 for none')
+    parser.add_argument('--pins', type=lambda x: [int(p) for p in x.split(',')], default=list(range(16)), help='comma list of input pins to toggle')
+    args = parser.parse_args()
+
+    sim = BWIOSimulator().start()
+    print("BWIO simulator on {}".format(sim.port), flush=True)
+    try:
+        while True:
+            if args.rate > 0:
+                sim.random(args.rate, 60, args.pins)
+            else:
+                time.sleep(60)
+    except KeyboardInterrupt:
+        sim.stop()
@@ -0,0 +1,273 @@
+#!/usr/bin/env python3
+"""
+ Just enough of an MQTT 3.1.1 broker to test soundserver.py against: QoS 0/1, retained messages, persistent
+ sessions that queue QoS 1 messages while the client is away, + and # wildcards, and a way to drop a
+ client's connection on purpose.  No will messages, auth is accepted and ignored.
+
+   ./mqttbroker.py --port 1883
+"""
+import argparse
+import asyncio
+import collections
+import struct
+import threading
+import time
+
+CONNECT, CONNACK, PUBLISH, PUBACK = 1, 2, 3, 4
+SUBSCRIBE, SUBACK, UNSUBSCRIBE, UNSUBACK = 8, 9, 10, 11
+PINGREQ, PINGRESP, DISCONNECT = 12, 13, 14
+
+
+def matches(pattern, topic):
+    pparts, tparts = pattern.split('/'), topic.split('/')
+    for ii, p in enumerate(pparts):
+        if p == '#':
+            return True
+        if ii >= len(tparts) or (p != '+' and p != tparts[ii]):
+            return False
+    return len(pparts) == len(tparts)
+
+def packet(ptype, flags, body):
+    header = bytearray([ptype << 4 | flags])
+    length = len(body)
+    while True:
+        byte, length = length % 128, length // 128
+        header.append(byte | (length and 0x80))
+        if not length:
+            return bytes(header) + body
+
+def string(s):
+    s = s.encode('utf-8') if isinstance(s, str) else s
+    return struct.pack('!H', len(s)) + s
+
+
+class Session(object):
+    """ What survives a disconnect when clean session is off """
+
+    def __init__(self, clientid):
+        self.clientid = clientid
+        self.subscriptions = dict()            # pattern: qos
+        self.queued = collections.deque()      # (topic, payload) for QoS 1 while away
+        self.inflight = collections.OrderedDict()  # packet id: (topic, payload) not yet acked
+        self.nextid = 0
+        self.clean = True
+        self.conn = None
+
+    def packetid(self):
+        self.nextid = self.nextid % 65535 + 1
+        return self.nextid
+
+
+class Connection(asyncio.Protocol):
+
+    def __init__(self, broker):
+        self.broker = broker
+        self.buf = bytearray()
+        self.session = None
+        self.transport = None
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def connection_lost(self, exc):
+        self.broker.lost(self)
+
+    def data_received(self, data):
+        self.buf += data
+        while True:
+            # fixed header is the type byte and a 1-4 byte length
+            length, mult, pos = 0, 1, 1
+            while True:
+                if pos >= len(self.buf):
+                    return
+                byte = self.buf[pos]
+                length += (byte & 0x7F) * mult
+                mult *= 128
+                pos += 1
+                if not byte & 0x80:
+                    break
+            if len(self.buf) < pos + length:
+                return
+            first, body = self.buf[0], bytes(self.buf[pos:pos+length])
+            del self.buf[:pos+length]
+            self.broker.handle(self, first >> 4, first & 0x0F, body)
+
+    def send(self, data):
+        if self.transport is not None and not self.transport.is_closing():
+            self.transport.write(data)
+
+
+class MQTTBroker(object):
+    """ Runs on its own thread and loop, call the public methods from anywhere """
+
+    def __init__(self, port=0):
+        self.port = port
+        self.sessions = dict()
+        self.retained = dict()
+        self.connects = []     # (clientid, perf_counter, session present)
+        self.kicks = []        # (clientid, perf_counter)
+        self._loop = asyncio.new_event_loop()
+        self._server = None
+        self._thread = threading.Thread(target=self._loop.run_forever, name='mqttbroker', daemon=True)
+
+    def start(self):
+        self._thread.start()
+        coro = self._loop.create_server(lambda: Connection(self), '127.0.0.1', self.port)
+        self._server = asyncio.run_coroutine_threadsafe(coro, self._loop).result()
+        self.port = self._server.sockets[0].getsockname()[1]
+        return self
+
+    def stop(self):
+        self._call(self._stop)
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+
+    def publish(self, topic, payload, qos=1, retain=False):
+        """ Publish as if from another client """
+        self._loop.call_soon_threadsafe(self._route, topic, payload, qos, retain)
+
+    def kick(self, clientid):
+        """ Drop a client's connection without any warning, returns when done """
+        return self._call(self._kick, clientid)
+
+    def connected(self, clientid):
+        session = self.sessions.get(clientid)
+        return session is not None and session.conn is not None
+
+    def _call(self, func, *args):
+        done = threading.Event()
+        result = []
+        def run():
+            result.append(func(*args))
+            done.set()
+        self._loop.call_soon_threadsafe(run)
+        done.wait()
+        return result[0]
+
+    def _stop(self):
+        self._server.close()
+        for session in self.sessions.values():
+            if session.conn is not None:
+                session.conn.transport.close()
+
+    def _kick(self, clientid):
+        session = self.sessions.get(clientid)
+        if session is None or session.conn is None:
+            return False
+        self.kicks.append((clientid, time.perf_counter()))
+        session.conn.transport.abort()
+        self.lost(session.conn)
+        return True
+
+    def lost(self, conn):
+        session = conn.session
+        if session is not None and session.conn is conn:
+            session.conn = None
+            if session.clean:
+                del self.sessions[session.clientid]
+
+    def handle(self, conn, ptype, flags, body):
+        if ptype == CONNECT:
+            self._connect(conn, body)
+        elif conn.session is None:
+            conn.transport.close()
+        elif ptype == PUBLISH:
+            qos = (flags >> 1) & 3
+            tlen = struct.unpack('!H', body[:2])[0]
+            topic = body[2:2+tlen].decode('utf-8')
+            pos = 2 + tlen
+            if qos:
+                pid = body[pos:pos+2]
+                pos += 2
+                conn.send(packet(PUBACK, 0, pid))
+            self._route(topic, body[pos:], qos, bool(flags & 1))
+        elif ptype == PUBACK:
+            conn.session.inflight.pop(struct.unpack('!H', body[:2])[0], None)
+        elif ptype == SUBSCRIBE:
+            pid, pos, granted = body[:2], 2, []
+            while pos < len(body):
+                tlen = struct.unpack('!H', body[pos:pos+2])[0]
+                pattern = body[pos+2:pos+2+tlen].decode('utf-8')
+                qos = min(body[pos+2+tlen], 1)
+                pos += 3 + tlen
+                conn.session.subscriptions[pattern] = qos
+                granted.append((pattern, qos))
+            conn.send(packet(SUBACK, 0, pid + bytes(q for p, q in granted)))
+            for pattern, qos in granted:
+                for topic, payload in self.retained.items():
+                    if matches(pattern, topic):
+                        self._deliver(conn.session, topic, payload, qos, True)
+        elif ptype == UNSUBSCRIBE:
+            pid, pos = body[:2], 2
+            while pos < len(body):
+                tlen = struct.unpack('!H', body[pos:pos+2])[0]
+                conn.session.subscriptions.pop(body[pos+2:pos+2+tlen].decode('utf-8'), None)
+                pos += 2 + tlen
+            conn.send(packet(UNSUBACK, 0, pid))
+        elif ptype == PINGREQ:
+            conn.send(packet(PINGRESP, 0, b''))
+        elif ptype == DISCONNECT:
+            conn.transport.close()
+
+    def _connect(self, conn, body):
+        pos = 2 + struct.unpack('!H', body[:2])[0]   # protocol name
+        cflags = body[pos+1]
+        pos += 4                                       # level, flags, keepalive
+        idlen = struct.unpack('!H', body[pos:pos+2])[0]
+        clientid = body[pos+2:pos+2+idlen].decode('utf-8')
+        clean = bool(cflags & 0x02)
+
+        session = self.sessions.get(clientid)
+        present = session is not None and not clean
+        if session is not None and session.conn is not None:   # take over from the old connection
+            old, session.conn = session.conn, None
+            old.transport.abort()
+        if not present:
+            session = self.sessions[clientid] = Session(clientid)
+        session.clean = clean
+        session.conn = conn
+        conn.session = session
+        self.connects.append((clientid, time.perf_counter(), present))
+        conn.send(packet(CONNACK, 0, bytes([int(present), 0])))
+
+        # resend anything unacknowledged then whatever queued up while they were away
+        for pid, (topic, payload) in session.inflight.items():
+            conn.send(packet(PUBLISH, 0x08 | 0x02, string(topic) + struct.pack('!H', pid) + payload))
+        while session.queued:
+            self._deliver(session, *session.queued.popleft(), qos=1, retain=False)
+
+    def _route(self, topic, payload, qos, retain):
+        if retain:
+            if payload:
+                self.retained[topic] = payload
+            else:
+                self.retained.pop(topic, None)
+        for session in self.sessions.values():
+            granted = [q for p, q in session.subscriptions.items() if matches(p, topic)]
+            if granted:
+                self._deliver(session, topic, payload, min(qos, max(granted)), False)
+
+    def _deliver(self, session, topic, payload, qos, retain):
+        if session.conn is None:
+            if qos:
+                session.queued.append((topic, payload))
+            return
+        if qos:
+            pid = session.packetid()
+            session.inflight[pid] = (topic, payload)
+            session.conn.send(packet(PUBLISH, 0x02 | retain, string(topic) + struct.pack('!H', pid) + payload))
+        else:
+            session.conn.send(packet(PUBLISH, retain, string(topic) + payload))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Stand-in MQTT broker')
+    parser.add_argument('--port', type=int, default=1883)
+    args = parser.parse_args()
+    broker = MQTTBroker(args.port).start()
+    print("listening on {}".format(broker.port))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        broker.stop()